@@ -1,27 +1,26 @@
-import cv2
+import argparse
+from pathlib import Path
 from utils import (
+    GEOMETRY_RATIOS,
+    RATIO_WALLPAPER_DIRS,
     WallpaperInfo,
-    Face,
-    Cropper,
-    WALLPAPER_DIR,
-    box_to_geometry,
-    SQUARE_ASPECT_RATIO,
+    compute_missing_ratios,
+    parse_ratio_str,
+    save_ratios,
 )
 
 # adds a new aspect ratio
 if __name__ == "__main__":
-    IMAGE_DATA = WallpaperInfo()
-    for fname, info in sorted(IMAGE_DATA.data.items()):
-        print(fname)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ratio", type=parse_ratio_str, help="e.g. r1x1")
+    parser.add_argument("output_dir", type=Path, help="for the cropped wallpapers")
+    args = parser.parse_args()
 
-        cropper = Cropper(
-            cv2.imread(str(WALLPAPER_DIR / fname)),
-            [
-                Face(xmin=f["xmin"], xmax=f["xmax"], ymin=f["ymin"], ymax=f["ymax"])
-                for f in info["faces"]
-            ],
-            aspect_ratio=SQUARE_ASPECT_RATIO,
-        )
+    if args.ratio not in RATIO_WALLPAPER_DIRS:
+        GEOMETRY_RATIOS.append(args.ratio)
+    RATIO_WALLPAPER_DIRS[args.ratio] = args.output_dir.expanduser()
+    save_ratios(RATIO_WALLPAPER_DIRS)
 
-        IMAGE_DATA[fname]["r1x1"] = box_to_geometry(cropper.crop())
-    IMAGE_DATA.save()
+    IMAGE_DATA = WallpaperInfo()
+    compute_missing_ratios(IMAGE_DATA)
+    IMAGE_DATA.export_csv()
@@ -0,0 +1,304 @@
+import argparse
+import cv2
+import functools
+import json
+import numpy as np
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+# never load the face detection model, nothing here should need it
+os.environ.setdefault(
+    "FACE_DETECTOR_CMD",
+    f"{sys.executable} {Path(__file__).parent / 'detect_worker.py'} --fake",
+)
+
+import utils  # noqa: E402
+from preview import draw_preview  # noqa: E402
+from utils import Cropper, Face, VERTICAL_ASPECT_RATIO, draw, faces_array  # noqa: E402
+from viewer import resize_for_display  # noqa: E402
+
+# 4x upscaled ultrawide wallpaper
+LARGE_IMAGE: tuple[int, int] = (13760, 5760)
+IMAGE_SIZES: list[tuple[int, int]] = [(1920, 1080), (3440, 1440), LARGE_IMAGE]
+FACE_COUNTS = [0, 1, 2, 10, 50]
+METADATA_ROWS = [1000, 10000, 100000]
+
+BASELINE_PATH = Path(__file__).parent / "benchmark_baseline.json"
+# allowed slowdown compared to the baseline before failing
+TOLERANCE = 0.2
+
+# {name: {"ops": operations per second, "peak_bytes": peak memory}}
+Results = dict[str, dict[str, float]]
+
+
+def synthetic_image(path: Path, width: int, height: int):
+    """Writes a png with some noise, so it does not compress down to nothing."""
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)
+    image = np.broadcast_to(gradient[None, :, None], (height, width, 3)).copy()
+    image[::7, ::5] = rng.integers(0, 255, (len(range(0, height, 7)), 1, 3))
+    cv2.imwrite(str(path), image)
+
+
+def synthetic_faces(width: int, height: int, count: int) -> list[Face]:
+    rng = np.random.default_rng(count)
+    size = min(width, height) // 10
+    faces = []
+    for x, y in zip(
+        rng.integers(0, width - size, count), rng.integers(0, height - size, count)
+    ):
+        faces.append(
+            Face(xmin=int(x), ymin=int(y), xmax=int(x) + size, ymax=int(y) + size)
+        )
+    return faces
+
+
+def measure(func: Callable, min_time=0.2, max_runs=1000) -> dict[str, float]:
+    """
+    Runs func until min_time has passed, returns the operations per second and the
+    peak memory allocated by python during a single run.
+    """
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or runs >= max_runs:
+            break
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"ops": runs / elapsed, "peak_bytes": peak}
+
+
+def bench_crop() -> Results:
+    results = {}
+    for width, height in IMAGE_SIZES:
+        for count in FACE_COUNTS:
+            # as stored in the metadata
+            faces = faces_array(synthetic_faces(width, height, count))
+            name = f"{width}x{height}/{count}faces"
+
+            def crop():
+                Cropper((width, height), faces, VERTICAL_ASPECT_RATIO).crop()
+
+            def crop_candidates():
+                Cropper((width, height), faces, VERTICAL_ASPECT_RATIO).crop_candidates()
+
+            def geometries():
+                Cropper((width, height), faces).geometries()
+
+            results[f"crop/{name}"] = measure(crop)
+            results[f"crop_candidates/{name}"] = measure(crop_candidates)
+            results[f"geometries/{name}"] = measure(geometries)
+    return results
+
+
+def synthetic_rows(count: int) -> dict[str, dict]:
+    width, height = LARGE_IMAGE
+    rows = {}
+    for i in range(count):
+        cropper = Cropper((width, height), synthetic_faces(width, height, i % 5))
+        rows[f"{i:06}.png"] = {
+            "faces": cropper.boxes,
+            # the geometries are the same for every row anyways
+            "r1440x2560": "2400x4267+10077+0",
+            "r2256x1504": "6400x4267+5416+0",
+            "r3440x1440": "10193x4267+2284+0",
+            "r1920x1080": "7585x4267+4892+0",
+            "r1x1": "4267x4267+7992+0",
+            "width": width,
+            "height": height,
+        }
+    return rows
+
+
+def bench_metadata(row_counts: list[int]) -> Results:
+    results = {}
+    orig_dir = utils.WALLPAPER_DIR
+    for count in row_counts:
+        rows = synthetic_rows(count)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            utils.WALLPAPER_DIR = Path(tmpdir)
+
+            def save():
+                image_data = utils.WallpaperInfo()
+                for fname, row in rows.items():
+                    image_data[fname] = row
+                image_data.save()
+
+            def load():
+                image_data = utils.WallpaperInfo()
+                for _ in image_data.items():
+                    pass
+
+            def export_csv():
+                utils.WallpaperInfo().export_csv()
+
+            results[f"metadata_save/{count}rows"] = measure(save, max_runs=5)
+            results[f"metadata_load/{count}rows"] = measure(load, max_runs=5)
+            results[f"metadata_export_csv/{count}rows"] = measure(
+                export_csv, max_runs=5
+            )
+
+        utils.WALLPAPER_DIR = orig_dir
+    return results
+
+
+def compare_baseline(results: Results, baseline: Results) -> list[str]:
+    """Returns the names of the benchmarks that are slower than the baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        change = result["ops"] / baseline[name]["ops"] - 1
+        print(f"  {name:<45} {change:+7.1%}")
+        if change < -TOLERANCE:
+            regressions.append(name)
+    return regressions
+
+
+def peak_rss() -> int:
+    """
+    Peak resident memory of this process in bytes. Unlike ru_maxrss, VmHWM is not
+    inherited from the parent process.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def draw_preview_full(path: Path, faces: list[Face], ratio: tuple[int, int]):
+    """Preview rendering at full resolution, before reduced size decoding."""
+    image = cv2.imread(str(path))
+    rect = Cropper(image, faces, ratio).crop()
+    drawn_image = draw(image, [rect, *faces], color=(0, 0, 255), thickness=3)
+    return resize_for_display(drawn_image)
+
+
+PREVIEW_RENDERERS = {
+    "full": draw_preview_full,
+    "reduced": functools.partial(draw_preview, cached=False),
+    # the first render creates the thumbnail, the median is of cached renders
+    "thumbnail": draw_preview,
+}
+
+
+def bench_preview_render(mode: str, path: Path, repeat: int):
+    """Runs in a separate process so the peak memory is for a single mode."""
+    faces = synthetic_faces(*LARGE_IMAGE, 5)
+    render = PREVIEW_RENDERERS[mode]
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(path, faces, VERTICAL_ASPECT_RATIO)
+        times.append(time.perf_counter() - start)
+
+    print(json.dumps({"latency": sorted(times)[len(times) // 2], "maxrss": peak_rss()}))
+
+
+def bench_preview(repeat: int) -> Results:
+    width, height = LARGE_IMAGE
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for ext in ("png", "jpg"):
+            path = Path(tmpdir) / f"large.{ext}"
+            synthetic_image(path, width, height)
+
+            print(f"preview render of a {width}x{height} {ext} (median of {repeat})")
+            for mode in PREVIEW_RENDERERS:
+                output = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "preview-render",
+                        mode,
+                        path,
+                        str(repeat),
+                    ],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                    # keep the thumbnails out of the real cache
+                    env={**os.environ, "XDG_CACHE_HOME": tmpdir},
+                ).stdout
+                result = json.loads(output)
+                results[f"preview/{ext}/{mode}"] = {
+                    "ops": 1 / result["latency"],
+                    "peak_bytes": result["maxrss"],
+                }
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "preview-render":
+        _, _, mode, path, repeat = sys.argv
+        bench_preview_render(mode, Path(path), int(repeat))
+        sys.exit()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "suites",
+        nargs="*",
+        help="crop, metadata or preview, defaults to crop and metadata",
+    )
+    parser.add_argument(
+        "--rows", nargs="+", type=int, default=METADATA_ROWS, help="metadata sizes"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="preview renders")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="store results as the baseline"
+    )
+    args = parser.parse_args()
+    # the preview suite is slow, only run it when asked
+    args.suites = args.suites or ["crop", "metadata"]
+    for suite in args.suites:
+        if suite not in ("crop", "metadata", "preview"):
+            parser.error(f"unknown suite {suite}")
+
+    results: Results = {}
+    if "crop" in args.suites:
+        results.update(bench_crop())
+    if "metadata" in args.suites:
+        results.update(bench_metadata(args.rows))
+    if "preview" in args.suites:
+        results.update(bench_preview(args.repeat))
+
+    for name, result in results.items():
+        print(
+            f"{name:<45} {result['ops']:12.1f} ops/s "
+            f"{result['peak_bytes'] / 1024 / 1024:9.2f} MiB"
+        )
+
+    if args.save_baseline:
+        baseline = (
+            json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        )
+        args.baseline.write_text(json.dumps({**baseline, **results}, indent=2))
+        print(f"saved baseline to {args.baseline}")
+    elif args.baseline.exists():
+        print(f"compared to baseline {args.baseline}")
+        regressions = compare_baseline(results, json.loads(args.baseline.read_text()))
+        if regressions:
+            print(f"REGRESSION: {len(regressions)} benchmarks slower than baseline")
+            for name in regressions:
+                print(f"  {name}")
+            sys.exit(1)
@@ -1,7 +1,9 @@
 import cv2
+import functools
 import os
 from pathlib import Path
 from utils import (
+    GEOMETRY_RATIOS,
     Cropper,
     VERTICAL_ASPECT_RATIO,
     WALLPAPER_DIR,
@@ -9,7 +11,9 @@ from utils import (
     box_to_geometry,
     detect,
     iter_images,
+    ratio_str,
 )
+from viewer import Frame, Viewer, read_for_display, resize_for_display, scale_boxes
 
 INPUT_DIR = Path("in/preview")
 BOX_COLORS = [
@@ -63,13 +67,53 @@ def draw(image, faces, font_scale=3, thickness=1):
     return image
 
 
+def render_choices(path: Path, ratio: tuple[int, int]) -> Frame | None:
+    # use defaults
+    fname = path.name
+    wallpaper = str(WALLPAPER_DIR / fname)
+
+    if not os.path.exists(wallpaper):
+        wallpaper = wallpaper.replace(".jpg", ".png")
+
+    faces = detect(wallpaper)
+
+    # skip if no faces
+    if not faces:
+        return None
+
+    # boxes are drawn on a reduced size image, scaled to match
+    image, dimensions, scale = read_for_display(wallpaper)
+    cropper = Cropper(
+        dimensions,
+        faces,
+        # use aspect ratio from the input image?
+        aspect_ratio=ratio,
+    )
+    # only as many as there are keys to choose them with
+    rects = cropper.crop_candidates(max_candidates=len(VALID_KEYS))
+    drawn_image = draw(
+        image,
+        scale_boxes(rects, scale),
+        font_scale=3 * scale,
+        thickness=max(round(3 * scale), 1),
+    )
+
+    return Frame(resize_for_display(drawn_image), rects)
+
+
 if __name__ == "__main__":
     # TODO: allow selecting for other aspect ratios?
     ratio = VERTICAL_ASPECT_RATIO
+    # the selection is stored in the column of the ratio
+    if ratio not in GEOMETRY_RATIOS:
+        raise SystemExit(
+            f"{ratio_str(ratio)} is not configured, add it with `python add.py`"
+        )
 
     # skip images if already cropped
     image_paths = sorted(iter_images(INPUT_DIR))
     IMAGE_DATA = WallpaperInfo()
+    viewer = Viewer(image_paths, functools.partial(render_choices, ratio=ratio))
 
     print("Start inferencing. Press `q` to cancel. Press  `-` to go back.")
     idx = 0
@@ -77,36 +121,17 @@ if __name__ == "__main__":
         if idx >= len(image_paths) or idx < 0:
             break
 
-        path = image_paths[idx]
-
-        # use defaults
-        fname = path.name
-        wallpaper = str(WALLPAPER_DIR / fname)
-
-        if not os.path.exists(wallpaper):
-            wallpaper = wallpaper.replace(".jpg", ".png")
-
-        image = cv2.imread(wallpaper)
-        faces = detect(wallpaper)
+        fname = image_paths[idx].name
+        frame = viewer.get(idx)
 
         # skip if no faces
-        if not faces:
+        if frame is None:
             idx += 1
             continue
 
         # display the images
-        cropper = Cropper(
-            image,
-            faces,
-            # use aspect ratio from the input image?
-            aspect_ratio=ratio,
-        )
-        rects = cropper.crop_candidates()
-        drawn_image = draw(image, rects, thickness=3)
-
-        w, h = image.shape[:2][::-1]
-        resized_image = cv2.resize(drawn_image, (1280, int(h / w * 1280)))
-        cv2.imshow("Image", resized_image)
+        rects = frame.data
+        cv2.imshow("Image", frame.image)
 
         key = cv2.waitKey(0) & 0xFF
         # esc
@@ -126,11 +151,13 @@ if __name__ == "__main__":
             rect = rects[sel]
 
             # update the data
-            ratio_str = f"r{ratio[0]}x{ratio[1]}"
-            IMAGE_DATA[fname][ratio_str] = box_to_geometry(rect)
+            IMAGE_DATA[fname][ratio_str(ratio)] = box_to_geometry(rect)
 
             IMAGE_DATA.save()
 
             idx = idx + 1
         else:
             idx = idx + 1
+
+    viewer.close()
+    IMAGE_DATA.export_csv()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import sys
+import traceback
+
+# a json list of image paths is read per line from stdin, and a json object of
+# {path: faces} (same output as `anime-face-detector`) is written per line to stdout.
+# faces are null for images that could not be processed.
+
+# same as `anime-face-detector`: the default model of create_detector() and the
+# score threshold of the upstream demo
+DEFAULT_MODEL = "yolov3"
+FACE_SCORE_THRESHOLD = 0.5
+# change when the detection code changes, invalidating cached faces
+DETECTOR_VERSION = "1"
+
+
+def fake_detector(path: str):
+    """
+    Stand-in for the face detector that does not need a model or GPU. Returns a
+    single face in the center of the image, sized a tenth of the image.
+    """
+    from PIL import Image
+
+    width, height = Image.open(path).size
+    w, h = width // 10, height // 10
+    xmin, ymin = (width - w) // 2, (height - h) // 2
+    return [{"xmin": xmin, "ymin": ymin, "xmax": xmin + w, "ymax": ymin + h}]
+
+
+def model_detector(model_name=DEFAULT_MODEL, score_threshold=FACE_SCORE_THRESHOLD):
+    import cv2
+    from anime_face_detector import create_detector
+
+    model = create_detector(model_name)
+
+    def detector(path: str):
+        image = cv2.imread(path)
+        if image is None:
+            raise ValueError(f"could not read {path}")
+
+        preds = model(image)
+        return [
+            {
+                "xmin": int(xmin),
+                "ymin": int(ymin),
+                "xmax": int(xmax),
+                "ymax": int(ymax),
+            }
+            for xmin, ymin, xmax, ymax, score in (pred["bbox"] for pred in preds)
+            if score >= score_threshold
+        ]
+
+    return detector
+
+
+def detect_all(detector, paths: list[str]) -> dict:
+    results = {}
+    for path in paths:
+        try:
+            results[path] = detector(path)
+        except Exception:
+            # keep the model loaded for the other images
+            traceback.print_exc()
+            results[path] = None
+    return results
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fake", action="store_true", help="stand-in that does not need a model"
+    )
+    parser.add_argument(
+        "--model", default=DEFAULT_MODEL, choices=["yolov3", "faster-rcnn"]
+    )
+    parser.add_argument("--score-threshold", type=float, default=FACE_SCORE_THRESHOLD)
+    return parser.parse_args(argv)
+
+
+def cache_version(args: argparse.Namespace) -> str:
+    """Identifies the results of the worker run with args, for caching faces."""
+    if args.fake:
+        return f"{DETECTOR_VERSION}:fake"
+    return f"{DETECTOR_VERSION}:{args.model}-{args.score_threshold}"
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # keep stdout for results only, anything printed while loading the model
+    # (including from native code) goes to stderr instead
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    detector = (
+        fake_detector if args.fake else model_detector(args.model, args.score_threshold)
+    )
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        out.write(json.dumps(detect_all(detector, json.loads(line))) + "\n")
+        out.flush()
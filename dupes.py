@@ -0,0 +1,74 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from utils import (
+    DUPLICATE_DISTANCE,
+    WALLPAPER_DIR,
+    HashIndex,
+    WallpaperInfo,
+    add_profile_argument,
+    dhash,
+    enable_profiling,
+)
+
+
+def wallpaper_dhash(fname: str) -> tuple[str, str | None]:
+    try:
+        return fname, dhash(WALLPAPER_DIR / fname)
+    # deleted or unreadable
+    except OSError:
+        return fname, None
+
+
+# lists wallpapers that are the same image, e.g. at a different resolution or format
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--distance",
+        type=int,
+        default=DUPLICATE_DISTANCE,
+        help="max number of differing bits of the perceptual hashes",
+    )
+    parser.add_argument("--workers", type=int, help="defaults to the number of cpus")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    IMAGE_DATA = WallpaperInfo()
+    IMAGE_DATA.prune()
+
+    # hash wallpapers processed before the hashes were stored
+    missing = [fname for fname, wall in IMAGE_DATA.items() if not wall.get("dhash")]
+    if missing:
+        print(f"hashing {len(missing)} wallpapers")
+        with ProcessPoolExecutor(args.workers) as executor:
+            for fname, digest in executor.map(wallpaper_dhash, missing, chunksize=16):
+                if digest is not None:
+                    IMAGE_DATA[fname]["dhash"] = digest
+        IMAGE_DATA.save()
+        IMAGE_DATA.export_csv()
+
+    walls = {fname: wall for fname, wall in IMAGE_DATA.items() if wall.get("dhash")}
+    index = HashIndex(args.distance)
+    for fname, wall in walls.items():
+        index.add(int(wall["dhash"], 16), fname)
+
+    groups = 0
+    for fname, wall in walls.items():
+        # each pair is only listed under the first wallpaper
+        matches = [
+            (distance, other)
+            for distance, other in index.search(int(wall["dhash"], 16))
+            if other > fname
+        ]
+        if not matches:
+            continue
+
+        groups += 1
+        print(f"{fname} ({wall['width']}x{wall['height']})")
+        for distance, other in matches:
+            print(
+                f"  {other} ({walls[other]['width']}x{walls[other]['height']}), "
+                f"distance {distance}"
+            )
+
+    print(f"{groups} wallpapers with duplicates out of {len(walls)}")
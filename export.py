@@ -0,0 +1,154 @@
+import argparse
+import cv2
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from utils import (
+    AspectRatio,
+    CACHE_DIR,
+    RATIO_WALLPAPER_DIRS,
+    WALLPAPER_DIR,
+    WallpaperInfo,
+    add_profile_argument,
+    compute_missing_ratios,
+    enable_profiling,
+    geometry_to_box,
+    parse_ratio_str,
+    ratio_str,
+)
+
+# records what each exported wallpaper was created from, to skip up to date ones
+MANIFEST_PATH = CACHE_DIR / "export.json"
+
+# (output path, geometry, aspect ratio, manifest stamp)
+ExportOutput = tuple[Path, str, AspectRatio, str]
+
+
+def export_wallpaper(
+    job: tuple[Path, list[ExportOutput], bool],
+) -> tuple[Path, list[tuple[Path, str]]]:
+    """
+    Decodes the wallpaper once and writes the crop for every output. Nothing is
+    written if the wallpaper cannot be read.
+    """
+    src, outputs, resize = job
+    image = cv2.imread(str(src))
+    # unreadable or truncated
+    if image is None:
+        return src, []
+
+    written = []
+    for out_path, geometry, ratio, stamp in outputs:
+        box = geometry_to_box(geometry)
+        # slicing does not copy the image
+        cropped = image[box["ymin"] : box["ymax"], box["xmin"] : box["xmax"]]
+
+        # only ratios that are also resolutions, e.g. not 1x1
+        if resize and ratio[0] > 1 and ratio[1] > 1:
+            cropped = cv2.resize(cropped, ratio, interpolation=cv2.INTER_AREA)
+
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        cv2.imwrite(str(out_path), cropped)
+        written.append((out_path, stamp))
+
+    return src, written
+
+
+def load_manifest() -> dict[str, str]:
+    try:
+        return json.loads(MANIFEST_PATH.read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest: dict[str, str]):
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = MANIFEST_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest))
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+# writes the cropped wallpapers for each aspect ratio to their directories
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--ratios",
+        nargs="+",
+        type=parse_ratio_str,
+        default=list(RATIO_WALLPAPER_DIRS),
+        help="e.g. r1440x2560, defaults to all",
+    )
+    parser.add_argument("--workers", type=int, help="defaults to the number of cpus")
+    parser.add_argument(
+        "--resize", action="store_true", help="resize to the exact resolution"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="also export up to date wallpapers"
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    for ratio in args.ratios:
+        if ratio not in RATIO_WALLPAPER_DIRS:
+            parser.error(f"no output directory for {ratio_str(ratio)}")
+
+    IMAGE_DATA = WallpaperInfo()
+    IMAGE_DATA.prune()
+    compute_missing_ratios(IMAGE_DATA, args.workers)
+    manifest = load_manifest()
+
+    jobs = []
+    for fname, wall in IMAGE_DATA.items():
+        src = WALLPAPER_DIR / fname
+        try:
+            src_mtime = src.stat().st_mtime_ns
+        except FileNotFoundError:
+            continue
+
+        outputs = []
+        for ratio in args.ratios:
+            geometry = wall.get(ratio_str(ratio))
+            if not geometry:
+                continue
+
+            out_path = RATIO_WALLPAPER_DIRS[ratio] / fname
+            stamp = f"{src_mtime}:{geometry}:{args.resize}"
+            if (
+                not args.force
+                and out_path.exists()
+                and manifest.get(str(out_path)) == stamp
+            ):
+                continue
+            outputs.append((out_path, geometry, ratio, stamp))
+
+        if outputs:
+            jobs.append((src, outputs, args.resize))
+
+    start = time.perf_counter()
+    failed = 0
+    try:
+        with ProcessPoolExecutor(args.workers) as executor:
+            for idx, (src, written) in enumerate(
+                executor.map(export_wallpaper, jobs), start=1
+            ):
+                # every job has outputs, so none were written if it failed
+                if not written:
+                    failed += 1
+                    print(f"[{idx}/{len(jobs)}] {src.name}: could not be read")
+                    continue
+
+                for out_path, stamp in written:
+                    manifest[str(out_path)] = stamp
+                print(f"[{idx}/{len(jobs)}] {src.name}")
+    finally:
+        # keep progress if interrupted
+        save_manifest(manifest)
+
+    print(
+        f"exported {len(jobs) - failed} wallpapers in "
+        f"{time.perf_counter() - start:.2f}s"
+        + (f", {failed} could not be read" if failed else "")
+    )
@@ -3,7 +3,11 @@
     nixpkgs.url = "github:NixOS/nixpkgs/nixos-unstable";
     systems.url = "github:nix-systems/default";
     devenv.url = "github:cachix/devenv";
-    anime-face-detector.url = "github:iynaix/anime-face-detector";
+    anime-face-detector = {
+      url = "github:iynaix/anime-face-detector";
+      # built against the same python, so it can be imported by detect_worker.py
+      inputs.nixpkgs.follows = "nixpkgs";
+    };
   };
 
   outputs =
@@ -31,6 +35,7 @@
                 # https://devenv.sh/reference/options/
                 packages = with pkgs; [
                   oxipng
+                  inotify-tools
                   anime-face-detector.packages.${system}.anime-face-detector
                   (callPackage ./nix/realcugan-ncnn-vulkan { })
                 ];
@@ -47,6 +52,9 @@
                       pillow
                       flake8
                       black
+                      pytest
+                      # anime_face_detector library for detect_worker.py
+                      (toPythonModule anime-face-detector.packages.${system}.anime-face-detector)
                       (opencv4.override { enableGtk3 = true; })
                     ]
                   );
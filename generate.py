@@ -1,49 +1,26 @@
-import cv2
 from utils import (
     WALLPAPER_DIR,
-    detect,
-    Cropper,
-    VERTICAL_ASPECT_RATIO,
-    FRAMEWORK_ASPECT_RATIO,
-    ULTRAWIDE_ASPECT_RATIO,
-    HD_ASPECT_RATIO,
+    add_wallpapers,
+    compute_missing_ratios,
+    iter_images,
     WallpaperInfo,
 )
 
 WallpaperGeometries = dict[str, dict[str, str]]
 
 
-def ratio_str(ratio: tuple[int, int]) -> str:
-    return f"r{ratio[0]}x{ratio[1]}"
-
-
 def swww(img: str, geometry: str, output: str) -> str:
     return f'convert "{img}" -crop "{geometry}" - | swww img --outputs "{output}" -;'
 
 
 if __name__ == "__main__":
-    ratios = [
-        VERTICAL_ASPECT_RATIO,
-        FRAMEWORK_ASPECT_RATIO,
-        ULTRAWIDE_ASPECT_RATIO,
-        HD_ASPECT_RATIO,
-    ]
-
     IMAGE_DATA = WallpaperInfo()
+    IMAGE_DATA.prune()
+    compute_missing_ratios(IMAGE_DATA)
 
-    for img in sorted(WALLPAPER_DIR.iterdir()):
-        fname = img.name
-
-        if fname in IMAGE_DATA or fname.endswith(".json"):
-            continue
-
-        print(fname)
-        image = cv2.imread(str(img))
-        faces = detect(str(img))
-        cropper = Cropper(image, faces)
-        IMAGE_DATA[fname] = {
-            "faces": cropper.faces_tuples(),
-            **cropper.geometries(),
-        }
+    new_images = [
+        img for img in sorted(iter_images(WALLPAPER_DIR)) if img.name not in IMAGE_DATA
+    ]
 
-    IMAGE_DATA.save()
+    add_wallpapers(IMAGE_DATA, new_images)
+    IMAGE_DATA.export_csv()
@@ -1,98 +1,477 @@
+import argparse
 import cv2
+import functools
+import os
+import random
+import shlex
 import shutil
 import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from PIL import Image
+from pipeline import Failed, Stage, run_pipeline
 from utils import (
+    PROFILER,
     Cropper,
+    DetectorError,
+    Dimensions,
+    Face,
     WallpaperInfo,
     WALLPAPER_DIR,
     VERTICAL_ASPECT_RATIO,
+    add_profile_argument,
+    compute_missing_ratios,
     detect,
+    detect_many,
+    dhash,
+    enable_profiling,
+    faces_to_dicts,
+    geometry_to_box,
+    image_size,
     iter_images,
+    optimize_png,
+    ratio_str,
+    scale_faces,
 )
 from pathlib import Path
 
 INPUT_DIR = Path("in")
+# create vertical wallpapers preview output directory
+PREVIEW_DIR = INPUT_DIR / "preview"
 
 TARGET_WIDTH = 3440
 TARGET_HEIGHT = 1504  # framework height
 
+# max images sent to the detector at once, only the images already waiting for
+# detection are sent, see --queue-size
+DETECT_BATCH_SIZE = 32
+
+# takes the same arguments as realcugan-ncnn-vulkan, e.g.
+# `UPSCALER_CMD="python upscale_stub.py"` for a CPU only stand-in
+UPSCALER_CMD = shlex.split(os.environ.get("UPSCALER_CMD", "")) or [
+    "realcugan-ncnn-vulkan"
+]
+
 
 def crop_from_geometry(geometry: str, input: str, output: str):
-    # split geometry into width, height, x, y
-    w, h, x, y = [
-        int(n)
-        for n in geometry.lstrip("r").replace("x", " ").replace("+", " ").split(" ")
-    ]
+    box = geometry_to_box(geometry)
 
-    xmax = x + w
-    ymax = y + h
+    with PROFILER.timer("decode"):
+        img = cv2.imread(input)
+    cv2.imwrite(output, img[box["ymin"] : box["ymax"], box["xmin"] : box["xmax"]])
 
-    img = cv2.imread(input)
-    cv2.imwrite(output, img[y:ymax, x:xmax])
 
+def get_scale_factor(p: Path) -> int:
+    width, height = Image.open(p).size
 
-if __name__ == "__main__":
-    # create vertical wallpapers preview output directory
-    PREVIEW_DIR = INPUT_DIR / "preview"
-    IMAGE_DATA = WallpaperInfo()
+    scale_factor = 1
+    for i in (1, 2, 3, 4):
+        if width * i >= TARGET_WIDTH and height * i >= TARGET_HEIGHT:
+            scale_factor = i
+            break
+    return scale_factor
 
-    for p in sorted(iter_images(INPUT_DIR)):
-        img = Image.open(p)
-        width, height = img.size
 
-        scale_factor = 1
-        for i in (1, 2, 3, 4):
-            if width * i >= TARGET_WIDTH and height * i >= TARGET_HEIGHT:
-                scale_factor = i
-                break
+def output_path(p: Path, scale_factor: int) -> Path:
+    # upscaled images are pngs
+    if scale_factor > 1:
+        return WALLPAPER_DIR / p.with_suffix(".png").name
+    return WALLPAPER_DIR / p.name
 
-        needs_upscale = scale_factor > 1
-        if needs_upscale:
-            out_path = WALLPAPER_DIR / (
-                p.name.replace(".jpg", ".png").replace(".jpeg", ".png")
-            )
 
-            subprocess.run(
+def upscale_group(scale_factor: int, group: list[Path]) -> dict[Path, Exception]:
+    """
+    Upscales the images with a single upscaler run, so the model is only loaded
+    once per group instead of once per image. Returns the errors of the images
+    that could not be upscaled.
+    """
+    errors = {}
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        in_dir = Path(tmpdir) / "in"
+        out_dir = Path(tmpdir) / "out"
+        in_dir.mkdir()
+        out_dir.mkdir()
+
+        # staged by index, as e.g. a.jpg and a.png would have the same output.
+        # copied, as realcugan only reads regular files and skips symlinks
+        for i, p in enumerate(group):
+            shutil.copy(p, in_dir / f"{i}{p.suffix}")
+
+        with PROFILER.timer("realcugan"):
+            proc = subprocess.run(
                 [
-                    "realcugan-ncnn-vulkan",
+                    *UPSCALER_CMD,
                     "-i",
-                    p,
+                    in_dir,
                     "-s",
                     str(scale_factor),
+                    "-f",
+                    "png",
                     "-o",
-                    out_path,
+                    out_dir,
                 ]
             )
+
+        for i, p in enumerate(group):
+            # some versions keep the original extension, e.g. 0.jpg.png
+            upscaled = next(out_dir.glob(f"{i}.*"), None)
+            if upscaled is None:
+                errors[p] = RuntimeError(
+                    f"no output from {UPSCALER_CMD[0]} "
+                    f"(exit code {proc.returncode})"
+                )
+                continue
+            shutil.move(upscaled, output_path(p, scale_factor))
+
+    print(
+        f"upscaled {len(group)} images by {scale_factor}x "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    return errors
+
+
+def upscale_batches(
+    executor: ThreadPoolExecutor, images: list[Path]
+) -> tuple[list[Path], dict[int, Future]]:
+    """
+    Starts upscaling the images in one batch per scale factor, one batch at a time
+    on the executor. Returns the images ordered by their batch, so the pipeline can
+    process each batch while the next one is upscaled, and the future of each
+    batch by scale factor.
+    """
+    groups: dict[int, list[Path]] = defaultdict(list)
+    for p in images:
+        try:
+            groups[get_scale_factor(p)].append(p)
+        # not upscaled, fails in upscale() instead of stopping the other images
+        except OSError:
+            groups[1].append(p)
+
+    batches = {
+        scale_factor: executor.submit(upscale_group, scale_factor, group)
+        for scale_factor, group in sorted(groups.items())
+        if scale_factor > 1
+    }
+    # images that are only copied first, they do not wait for a batch
+    return [p for _, group in sorted(groups.items()) for p in group], batches
+
+
+def upscale(
+    p: Path, batches: dict[int, Future] | None = None
+) -> tuple[Path, Path, bool]:
+    """
+    Copies the image if it does not need upscaling, otherwise waits for its batch
+    from upscale_batches(). Returns (input, output, needs optimize)
+    """
+    scale_factor = get_scale_factor(p)
+    out_path = output_path(p, scale_factor)
+
+    needs_upscale = scale_factor > 1
+    if needs_upscale:
+        # raises any exception from upscaling the batch
+        errors = batches[scale_factor].result()
+        if p in errors:
+            raise errors[p]
+    else:
+        # copy to output dir
+        shutil.copy(p, out_path)
+
+    return p, out_path, needs_upscale or p.suffix == ".png"
+
+
+def optimize(args: tuple[Path, Path, bool]) -> tuple[Path, Path]:
+    p, out_path, needs_optimize = args
+
+    # optimize png, skipped if already optimized
+    if needs_optimize:
+        optimize_png(out_path)
+
+    return p, out_path
+
+
+def find_duplicates(
+    image_data: WallpaperInfo, images: list[Path]
+) -> tuple[dict[Path, str | None], dict[Path, str]]:
+    """
+    Returns the perceptual hash of each image, None if it cannot be read, and the
+    wallpaper each duplicate image matches, either an existing wallpaper or an
+    earlier image.
+    """
+    index = image_data.dhash_index()
+    hashes = {}
+    duplicates = {}
+    for p in images:
+        try:
+            hashes[p] = dhash(p)
+            out_name = output_path(p, get_scale_factor(p)).name
+        # fails later in the pipeline
+        except OSError:
+            hashes[p] = None
+            continue
+
+        value = int(hashes[p], 16)
+        # reprocessing an image does not make it a duplicate
+        matches = [fname for _, fname in index.search(value) if fname != out_name]
+        if matches and out_name not in image_data:
+            duplicates[p] = matches[0]
         else:
-            # copy to output dir
-            out_path = WALLPAPER_DIR / p.name
-            shutil.copy(p, WALLPAPER_DIR / p.name)
-
-        # optimize png
-        if needs_upscale or p.suffix == ".png":
-            subprocess.run(["oxipng", "--opt", "max", out_path])
-
-        # crop faces and write data
-        faces = detect(str(out_path))
-        image = cv2.imread(str(out_path))
-        cropper = Cropper(image, faces)
-        geometries = cropper.geometries()
-
-        # output vertical image for preview
-        if len(faces) > 1:
-            PREVIEW_DIR.mkdir(exist_ok=True)
-
-            vertical_str = f"r{VERTICAL_ASPECT_RATIO[0]}x{VERTICAL_ASPECT_RATIO[1]}"
-            crop_from_geometry(
-                geometries[vertical_str],
-                str(out_path),
-                str(PREVIEW_DIR / p.name),
+            index.add(value, out_name)
+    return hashes, duplicates
+
+
+def detect_faces(
+    items: list[tuple[Path, Path]],
+    on_source=False,
+    max_side: int | None = None,
+    reused: dict[Path, tuple[list[Face], Dimensions]] | None = None,
+) -> list[tuple[Path, Path, list[Face]] | Exception]:
+    """
+    Detects the faces of the outputs, sending all of them to the detector at once.
+    If on_source, the faces are detected on the smaller source images before
+    upscaling and scaled to the outputs instead. Images in reused get the given
+    (faces, size) of a duplicate scaled to the output, without detection.
+    Returns the faces of each item, or the exception if it failed.
+    """
+    reused = reused or {}
+    detected = detect_many(
+        [p if on_source else out_path for p, out_path in items if p not in reused],
+        max_side=max_side,
+        progress=False,
+    )
+
+    ret = []
+    for p, out_path in items:
+        image = p if on_source else out_path
+        try:
+            if p in reused:
+                faces, size = reused[p]
+                faces = scale_faces(faces, size, image_size(out_path))
+            elif image not in detected:
+                raise DetectorError(f"face detection failed for {image}")
+            elif on_source:
+                faces = scale_faces(
+                    detected[image], image_size(p), image_size(out_path)
+                )
+            else:
+                faces = detected[image]
+            ret.append((p, out_path, faces))
+        except Exception as e:
+            ret.append(e)
+    return ret
+
+
+def iou(a: Face, b: Face) -> float:
+    width = min(a["xmax"], b["xmax"]) - max(a["xmin"], b["xmin"])
+    height = min(a["ymax"], b["ymax"]) - max(a["ymin"], b["ymin"])
+    if width <= 0 or height <= 0:
+        return 0
+
+    def area(f):
+        return (f["xmax"] - f["xmin"]) * (f["ymax"] - f["ymin"])
+
+    intersection = width * height
+    return intersection / (area(a) + area(b) - intersection)
+
+
+def validate_detection(images: list[Path], on_source: bool, max_side: int | None):
+    """
+    Compares the faces from detect_faces() with the given options to detecting on
+    the full size output, for images that have already been processed.
+    """
+    ious = []
+    drifts = []
+    missed = extra = changed_crops = 0
+    for p in images:
+        out_path = output_path(p, get_scale_factor(p))
+        expected = detect(out_path)
+        (result,) = detect_faces([(p, out_path)], on_source, max_side)
+        if isinstance(result, Exception):
+            raise result
+        _, _, faces = result
+
+        # match each expected face to the most overlapping detected face
+        unmatched = list(faces)
+        for face in expected:
+            best = max(unmatched, key=lambda f: iou(face, f), default=None)
+            if best is None or iou(face, best) < 0.5:
+                missed += 1
+                continue
+            unmatched.remove(best)
+            ious.append(iou(face, best))
+            drifts.append(max(abs(face[k] - best[k]) for k in face))
+        extra += len(unmatched)
+
+        size = image_size(out_path)
+        expected_geometries = Cropper(size, expected).geometries()
+        geometries = Cropper(size, faces).geometries()
+        shift = max(
+            abs(geometry_to_box(geometry)[k] - geometry_to_box(expected_geometry)[k])
+            for geometry, expected_geometry in zip(
+                geometries.values(), expected_geometries.values()
+            )
+            for k in ("xmin", "ymin", "xmax", "ymax")
+        )
+        if shift:
+            changed_crops += 1
+            print(f"{p.name}: crops shifted by up to {shift}px")
+
+    print(f"validated {len(images)} images, {len(ious)} matching faces")
+    if ious:
+        print(f"iou: mean {sum(ious) / len(ious):.3f}, min {min(ious):.3f}")
+        print(f"box drift: mean {sum(drifts) / len(drifts):.1f}px, max {max(drifts)}px")
+    print(f"{missed} faces missed, {extra} extra faces")
+    print(f"{changed_crops} images with different crops")
+
+
+def crop(args: tuple[Path, Path, list[Face]]) -> tuple[Path, dict]:
+    p, out_path, faces = args
+
+    # crop faces
+    width, height = image_size(out_path)
+    cropper = Cropper((width, height), faces)
+    geometries = cropper.geometries()
+
+    # output vertical image for preview
+    if len(faces) > 1:
+        PREVIEW_DIR.mkdir(exist_ok=True)
+
+        # the vertical ratio is not necessarily configured
+        preview_geometry = cropper.geometries([VERTICAL_ASPECT_RATIO])
+        crop_from_geometry(
+            preview_geometry[ratio_str(VERTICAL_ASPECT_RATIO)],
+            str(out_path),
+            str(PREVIEW_DIR / p.name),
+        )
+
+    return out_path, {
+        "filename": out_path.name,
+        **geometries,
+        "faces": cropper.boxes,
+        "width": width,
+        "height": height,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--upscale-workers", type=int, default=1)
+    parser.add_argument("--optimize-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--crop-workers", type=int, default=2)
+    parser.add_argument(
+        "--queue-size", type=int, default=4, help="max images waiting per stage"
+    )
+    parser.add_argument(
+        "--detect-on-source",
+        action="store_true",
+        help="detect faces before upscaling and scale them to the output",
+    )
+    parser.add_argument(
+        "--detect-max-side",
+        type=int,
+        help="downscale larger images to this size before detecting faces",
+    )
+    parser.add_argument(
+        "--validate",
+        type=int,
+        metavar="SAMPLES",
+        help="compare the detection options to detecting on the full output, "
+        "for already processed images",
+    )
+    parser.add_argument(
+        "--duplicates",
+        choices=["skip", "reuse", "process"],
+        default="skip",
+        help="for images that are the same as an existing wallpaper, skip them, "
+        "reuse the faces of the existing wallpaper, or process them anyways",
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    if args.validate:
+        processed = [
+            p
+            for p in sorted(iter_images(INPUT_DIR))
+            if output_path(p, get_scale_factor(p)).exists()
+        ]
+        validate_detection(
+            random.sample(processed, min(args.validate, len(processed))),
+            args.detect_on_source,
+            args.detect_max_side,
+        )
+        raise SystemExit
+
+    IMAGE_DATA = WallpaperInfo()
+    IMAGE_DATA.prune()
+    compute_missing_ratios(IMAGE_DATA)
+
+    images = sorted(iter_images(INPUT_DIR))
+    start = time.perf_counter()
+
+    hashes, duplicates = find_duplicates(IMAGE_DATA, images)
+    for p, fname in duplicates.items():
+        print(f"{p.name} is a duplicate of {fname}")
+    reused = {}
+    if args.duplicates == "skip":
+        images = [p for p in images if p not in duplicates]
+    elif args.duplicates == "reuse":
+        # duplicates of earlier images have no faces yet and are processed
+        for p, fname in duplicates.items():
+            wall = IMAGE_DATA.load(fname)
+            if wall is not None and wall["width"] and wall["height"]:
+                reused[p] = (
+                    faces_to_dicts(wall["faces"]),
+                    (wall["width"], wall["height"]),
+                )
+
+    # batches run one at a time, as they share the gpu
+    upscaler = ThreadPoolExecutor(1)
+    images, batches = upscale_batches(upscaler, images)
+
+    stages = [
+        Stage(
+            "upscale",
+            functools.partial(upscale, batches=batches),
+            args.upscale_workers,
+        ),
+        Stage("optimize", optimize, args.optimize_workers),
+        # the detector process is shared, so detection is not parallelized, instead
+        # the images waiting for detection are sent to the detector together
+        Stage(
+            "detect",
+            functools.partial(
+                detect_faces,
+                on_source=args.detect_on_source,
+                max_side=args.detect_max_side,
+                reused=reused,
+            ),
+            1,
+            batch_size=DETECT_BATCH_SIZE,
+        ),
+        Stage("crop", crop, args.crop_workers),
+    ]
+
+    for idx, (p, result) in enumerate(
+        run_pipeline(images, stages, maxsize=args.queue_size), start=1
+    ):
+        if isinstance(result, Failed):
+            print(
+                f"[{idx}/{len(images)}] {p.name}: {result.stage} failed: {result.error}"
             )
+            continue
 
-        IMAGE_DATA[out_path.name] = {
-            "filename": out_path.name,
-            **geometries,
-            "faces": cropper.faces_tuples(),
-        }
+        # write data in input order
+        out_path, info = result
+        IMAGE_DATA[out_path.name] = {**info, "dhash": hashes[p]}
         IMAGE_DATA.save()
+        print(f"[{idx}/{len(images)}] {p.name}")
+
+    upscaler.shutdown()
+    IMAGE_DATA.export_csv()
+
+    print(f"processed {len(images)} images in {time.perf_counter() - start:.2f}s")
+    for stage in stages:
+        print(stage.summary())
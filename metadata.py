@@ -0,0 +1,16 @@
+import argparse
+from pathlib import Path
+from utils import WallpaperInfo
+
+# import / export the wallpaper metadata database as csv
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("path", nargs="?", type=Path, help="defaults to wallpapers.csv")
+    args = parser.parse_args()
+
+    IMAGE_DATA = WallpaperInfo()
+    if args.command == "import":
+        IMAGE_DATA.import_csv(args.path or IMAGE_DATA.csv_path)
+    else:
+        IMAGE_DATA.export_csv(args.path)
@@ -0,0 +1,53 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from utils import (
+    OXIPNG_ARGS,
+    WALLPAPER_DIR,
+    add_profile_argument,
+    enable_profiling,
+    optimize_png,
+)
+
+
+def optimize(path: Path, args: list[str]) -> tuple[Path, int | None, float]:
+    start = time.perf_counter()
+    saved = optimize_png(path, args)
+    return path, saved, time.perf_counter() - start
+
+
+# optimizes every png in the wallpaper directory that has not been optimized yet
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # oxipng is a separate process, so threads are enough
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    paths = sorted(WALLPAPER_DIR.glob("*.png"))
+
+    start = time.perf_counter()
+    optimized = skipped = total_saved = 0
+    with ThreadPoolExecutor(args.workers) as executor:
+        futures = [executor.submit(optimize, p, OXIPNG_ARGS) for p in paths]
+        for idx, future in enumerate(as_completed(futures), start=1):
+            path, saved, elapsed = future.result()
+            if saved is None:
+                skipped += 1
+                continue
+
+            optimized += 1
+            total_saved += saved
+            print(
+                f"[{idx}/{len(paths)}] {path.name}: "
+                f"saved {saved / 1024:.1f} KiB in {elapsed:.2f}s"
+            )
+
+    print(
+        f"optimized {optimized} pngs, skipped {skipped} already optimized, "
+        f"saved {total_saved / 1024 / 1024:.2f} MiB "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
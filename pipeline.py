@@ -0,0 +1,139 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator, NamedTuple
+
+# marks the end of the items in a queue
+_DONE = object()
+
+
+class Failed(NamedTuple):
+    stage: str
+    error: Exception
+
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    # if more than 1, func is called with a list of up to batch_size of the items
+    # that are already waiting, and returns a list of their results in the same
+    # order, with an exception for each item that failed
+    batch_size: int = 1
+    # seconds spent in func for each item
+    times: list[float] = field(default_factory=list)
+
+    def summary(self) -> str:
+        if not self.times:
+            return f"{self.name}: 0 items"
+
+        total = sum(self.times)
+        return (
+            f"{self.name}: {len(self.times)} items, {total:.2f}s total, "
+            f"{total / len(self.times):.2f}s avg ({self.workers} workers)"
+        )
+
+
+def _process(stage: Stage, batch: list[tuple[int, Any]]) -> list[tuple[int, Any]]:
+    # failures are passed through to the end of the pipeline
+    todo = [(idx, value) for idx, value in batch if not isinstance(value, Failed)]
+    if not todo:
+        return batch
+
+    start = time.perf_counter()
+    values = [value for _, value in todo]
+    try:
+        if stage.batch_size > 1:
+            results = stage.func(values)
+        else:
+            results = [stage.func(values[0])]
+    except Exception as e:
+        results = [e] * len(todo)
+    elapsed = time.perf_counter() - start
+    stage.times.extend([elapsed / len(todo)] * len(todo))
+
+    processed = {
+        idx: Failed(stage.name, result) if isinstance(result, Exception) else result
+        for (idx, _), result in zip(todo, results)
+    }
+    return [(idx, processed.get(idx, value)) for idx, value in batch]
+
+
+def _run_stage(stage: Stage, inbox: queue.Queue, outbox: queue.Queue, next_workers):
+    lock = threading.Lock()
+    remaining = stage.workers
+
+    def worker():
+        nonlocal remaining
+
+        done = False
+        while not done:
+            item = inbox.get()
+            if item is _DONE:
+                break
+
+            batch = [item]
+            # take the items that are already waiting, without waiting for more
+            while len(batch) < stage.batch_size:
+                try:
+                    item = inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+
+            for idx, value in _process(stage, batch):
+                outbox.put((idx, value))
+
+        # the last worker to finish signals the workers of the next stage
+        with lock:
+            remaining -= 1
+            if remaining == 0:
+                for _ in range(next_workers):
+                    outbox.put(_DONE)
+
+    for _ in range(stage.workers):
+        threading.Thread(target=worker, daemon=True).start()
+
+
+def run_pipeline(
+    items: Iterable[Any], stages: list[Stage], maxsize=4
+) -> Iterator[tuple[Any, Any]]:
+    """
+    Runs each item through the stages in order. Every stage runs in its own worker
+    threads, connected to the next stage by a queue holding at most maxsize items.
+    Yields (item, result) in the order of items, the result is a Failed if any
+    stage raised an exception.
+    """
+    items = list(items)
+    queues = [queue.Queue(maxsize) for _ in range(len(stages) + 1)]
+
+    for i, stage in enumerate(stages):
+        next_workers = stages[i + 1].workers if i + 1 < len(stages) else 1
+        _run_stage(stage, queues[i], queues[i + 1], next_workers)
+
+    def feed():
+        for item in enumerate(items):
+            queues[0].put(item)
+        for _ in range(stages[0].workers):
+            queues[0].put(_DONE)
+
+    threading.Thread(target=feed, daemon=True).start()
+
+    # results can finish out of order, buffer them until the next one is done
+    pending = {}
+    next_idx = 0
+    while True:
+        result = queues[-1].get()
+        if result is _DONE:
+            break
+
+        idx, value = result
+        pending[idx] = value
+        while next_idx in pending:
+            yield items[next_idx], pending.pop(next_idx)
+            next_idx += 1
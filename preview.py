@@ -1,4 +1,5 @@
 import cv2
+import functools
 from pathlib import Path
 from utils import (
     Cropper,
@@ -10,28 +11,48 @@ from utils import (
     draw,
     iter_images,
 )
+from viewer import Frame, Viewer, read_for_display, resize_for_display, scale_boxes
 
 
-def preview_image(
-    image,
+def draw_preview(
+    path: Path,
     faces: list[Face],
-    idx: int,
     # (width, height)
     ratio: tuple[int, int] = (9, 16),
-) -> int:
-    rect = Cropper(image, faces, ratio).crop()
+    cached=True,
+):
+    # boxes are drawn on a reduced size image, scaled to match
+    image, dimensions, scale = read_for_display(path, cached)
+    rect = Cropper(dimensions, faces, ratio).crop()
 
     drawn_image = draw(
         image,
-        [rect, *faces],
+        scale_boxes([rect, *faces], scale),
         # BGR
         color=(0, 0, 255),
-        thickness=3,
+        thickness=max(round(3 * scale), 1),
     )
 
-    w, h = image.shape[:2][::-1]
-    resized_image = cv2.resize(drawn_image, (1280, int(h / w * 1280)))
-    cv2.imshow("Image", resized_image)
+    return resize_for_display(drawn_image)
+
+
+def render_preview(
+    path: Path,
+    # (width, height)
+    ratio: tuple[int, int] = (9, 16),
+) -> Frame | None:
+    # use defaults
+    faces = detect(str(path))
+
+    # skip if no faces
+    if not faces:
+        return None
+
+    return Frame(draw_preview(path, faces, ratio))
+
+
+def preview_image(frame: Frame, idx: int) -> int:
+    cv2.imshow("Image", frame.image)
 
     key = cv2.waitKey(0) & 0xFF
     # esc
@@ -56,28 +77,29 @@ if __name__ == "__main__":
     # uncomment to test specific images
     # image_paths = sorted(iter_images(Path("in")))
 
+    viewer = Viewer(
+        image_paths,
+        functools.partial(
+            render_preview,
+            ratio=VERTICAL_ASPECT_RATIO,
+            # ratio=FRAMEWORK_ASPECT_RATIO,
+        ),
+    )
+
     print("Start inferencing. Press `q` to cancel. Press  `-` to go back.")
     idx = 0
     while True:
         if idx >= len(image_paths) or idx < 0:
             break
 
-        path = image_paths[idx]
-
-        # use defaults
-        image = cv2.imread(str(path))
-        faces = detect(str(path))
+        frame = viewer.get(idx)
 
         # skip if no faces
-        if not faces:
+        if frame is None:
             idx += 1
             continue
 
         # display the images
-        idx = preview_image(
-            image,
-            faces,
-            idx,
-            ratio=VERTICAL_ASPECT_RATIO,
-            # ratio=FRAMEWORK_ASPECT_RATIO,
-        )
+        idx = preview_image(frame, idx)
+
+    viewer.close()
@@ -0,0 +1,136 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import time
+from utils import (
+    CACHE_DIR,
+    GEOMETRY_RATIOS,
+    WALLPAPER_DIR,
+    AspectRatio,
+    Cropper,
+    GeometryRow,
+    WallpaperInfo,
+    add_profile_argument,
+    enable_profiling,
+    faces_to_blob,
+    geometry_rows,
+    iter_geometries,
+    iter_images,
+    parse_ratio_str,
+    ratio_str,
+    update_geometries,
+)
+
+# geometries computed by an interrupted run, to resume from
+PROGRESS_PATH = CACHE_DIR / "recrop.json"
+
+
+def progress_version(ratios: list[AspectRatio]) -> str:
+    """Progress is discarded when the ratios or the crop logic change."""
+    source = inspect.getsource(Cropper) + " ".join(ratio_str(r) for r in ratios)
+    return hashlib.blake2b(source.encode(), digest_size=8).hexdigest()
+
+
+def row_key(row: GeometryRow) -> str:
+    """Changes whenever the geometries of the row could change."""
+    _, (width, height), faces = row
+    return f"{width}x{height}:{faces_to_blob(faces).hex()}"
+
+
+def load_progress(version: str) -> dict[str, list]:
+    """Returns {filename: [row key, geometries]} of the last interrupted run."""
+    try:
+        progress = json.loads(PROGRESS_PATH.read_text())
+    except FileNotFoundError:
+        return {}
+    return progress["done"] if progress["version"] == version else {}
+
+
+def save_progress(version: str, done: dict[str, list]):
+    PROGRESS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = PROGRESS_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps({"version": version, "done": done}))
+    os.replace(tmp_path, PROGRESS_PATH)
+
+
+# recomputes the geometries of the whole library from the stored faces and dimensions
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--ratios", nargs="+", type=parse_ratio_str, help="e.g. r1x1, defaults to all"
+    )
+    parser.add_argument("--workers", type=int, help="defaults to the number of cpus")
+    parser.add_argument(
+        "--chunk-size", type=int, default=500, help="wallpapers per worker task"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print how many geometries would change",
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    # geometries are only stored for configured ratios
+    for ratio in args.ratios or []:
+        if ratio not in GEOMETRY_RATIOS:
+            parser.error(
+                f"{ratio_str(ratio)} is not configured, add it with `python add.py`"
+            )
+
+    ratios = args.ratios or GEOMETRY_RATIOS
+    IMAGE_DATA = WallpaperInfo()
+    # both write to the database, so not done for dry runs
+    if not args.dry_run:
+        IMAGE_DATA.prune()
+        IMAGE_DATA.backfill_dimensions()
+
+    rows = geometry_rows(IMAGE_DATA)
+    if args.dry_run:
+        existing = {img.name for img in iter_images(WALLPAPER_DIR)}
+        deleted = [fname for fname in IMAGE_DATA.keys() if fname not in existing]
+        print(f"{len(deleted)} rows of deleted wallpapers would be removed")
+        rows = [row for row in rows if row[0] in existing]
+    version = progress_version(ratios)
+    done = {} if args.dry_run else load_progress(version)
+
+    todo = [row for row in rows if done.get(row[0], [None])[0] != row_key(row)]
+    if len(todo) < len(rows):
+        print(f"resuming, {len(rows) - len(todo)} wallpapers already recomputed")
+    keys = {row[0]: row_key(row) for row in todo}
+
+    start = time.perf_counter()
+    completed = len(rows) - len(todo)
+    try:
+        for chunk in iter_geometries(
+            todo, ratios, workers=args.workers, chunk_size=args.chunk_size
+        ):
+            for fname, geometries in chunk:
+                done[fname] = [keys[fname], geometries]
+            completed += len(chunk)
+            print(f"[{completed}/{len(rows)}] wallpapers recomputed")
+    except BaseException:
+        # keep progress if interrupted
+        if not args.dry_run:
+            save_progress(version, done)
+        raise
+    elapsed = time.perf_counter() - start
+
+    geometries = {fname: done[fname][1] for fname, *_ in rows}
+    if args.dry_run:
+        changed = sum(
+            IMAGE_DATA.load(fname).get(key) != value
+            for fname, new in geometries.items()
+            for key, value in new.items()
+        )
+        print(f"{changed} geometries would change")
+    else:
+        changed = update_geometries(IMAGE_DATA, geometries)
+        PROGRESS_PATH.unlink(missing_ok=True)
+        IMAGE_DATA.export_csv()
+        print(f"{changed} geometries changed")
+
+    print(f"recomputed {len(rows)} wallpapers in {elapsed:.2f}s")
@@ -0,0 +1,135 @@
+import argparse
+import os
+import select
+import subprocess
+from pathlib import Path
+from utils import (
+    WALLPAPER_DIR,
+    ManifestEntry,
+    WallpaperInfo,
+    add_profile_argument,
+    add_wallpapers,
+    compute_missing_ratios,
+    enable_profiling,
+    file_hash,
+    is_image,
+)
+
+# seconds without new events before processing them
+WATCH_DEBOUNCE = 2
+
+
+def sync(image_data: WallpaperInfo, names: set[str] | None = None):
+    """
+    Processes new or changed wallpapers and removes deleted ones, by comparing them
+    to the manifest. Only the given file names are checked, or every wallpaper
+    if None.
+    """
+    manifest = image_data.manifest()
+    if names is None:
+        names = {img.name for img in WALLPAPER_DIR.iterdir()}
+        names.update(manifest, image_data.keys())
+
+    changed: list[Path] = []
+    deleted: list[str] = []
+    entries: dict[str, ManifestEntry] = {}
+    for name in sorted(names):
+        path = WALLPAPER_DIR / name
+        if not path.is_file() or not is_image(path):
+            if name in manifest or name in image_data:
+                deleted.append(name)
+            continue
+
+        stat = path.stat()
+        entry = manifest.get(name)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            continue
+
+        # only touched files keep the same hash
+        digest = file_hash(path)
+        entries[name] = ManifestEntry(stat.st_size, stat.st_mtime_ns, digest)
+        if entry is not None and entry.hash == digest:
+            continue
+
+        # wallpapers processed before the manifest existed are assumed current
+        if entry is None and name in image_data:
+            continue
+
+        changed.append(path)
+
+    added = []
+    if changed:
+        added = add_wallpapers(image_data, changed)
+    # failed images are left out of the manifest, so they are retried next time
+    failed = {path.name for path in changed} - set(added)
+    for name in failed:
+        del entries[name]
+    if deleted:
+        image_data.delete(deleted)
+    image_data.update_manifest(entries)
+
+    if added or deleted:
+        image_data.export_csv()
+    print(
+        f"synced: {len(added)} new or changed, {len(deleted)} deleted"
+        + (f", {len(failed)} failed" if failed else "")
+    )
+
+
+def watch(image_data: WallpaperInfo):
+    """Syncs the wallpapers whenever files in the wallpaper directory change."""
+    proc = subprocess.Popen(
+        [
+            "inotifywait",
+            "--monitor",
+            "--quiet",
+            "--event",
+            "close_write,moved_to,moved_from,delete",
+            "--format",
+            "%f",
+            str(WALLPAPER_DIR),
+        ],
+        stdout=subprocess.PIPE,
+    )
+    fd = proc.stdout.fileno()
+
+    buffer = b""
+    names = set()
+    while True:
+        # wait for events to settle, e.g. while a file is still being copied
+        ready, _, _ = select.select([fd], [], [], WATCH_DEBOUNCE if names else None)
+        if not ready:
+            sync(image_data, names)
+            names.clear()
+            continue
+
+        data = os.read(fd, 65536)
+        # inotifywait exited
+        if not data:
+            if names:
+                sync(image_data, names)
+            break
+
+        *lines, buffer = (buffer + data).split(b"\n")
+        for line in lines:
+            name = os.fsdecode(line)
+            # ignore writes to the metadata and csv
+            if is_image(Path(name)):
+                names.add(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--watch", action="store_true", help="keep syncing as files change"
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    IMAGE_DATA = WallpaperInfo()
+    compute_missing_ratios(IMAGE_DATA)
+    sync(IMAGE_DATA)
+
+    if args.watch:
+        watch(IMAGE_DATA)
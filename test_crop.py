@@ -0,0 +1,242 @@
+import random
+from collections import defaultdict
+from utils import (
+    FRAMEWORK_ASPECT_RATIO,
+    HD_ASPECT_RATIO,
+    SQUARE_ASPECT_RATIO,
+    ULTRAWIDE_ASPECT_RATIO,
+    VERTICAL_ASPECT_RATIO,
+    Cropper,
+    Face,
+    FaceIntersections,
+)
+
+RATIOS = [
+    VERTICAL_ASPECT_RATIO,
+    FRAMEWORK_ASPECT_RATIO,
+    ULTRAWIDE_ASPECT_RATIO,
+    HD_ASPECT_RATIO,
+    SQUARE_ASPECT_RATIO,
+    (9, 16),
+    (21, 9),
+    (3, 2),
+]
+
+
+class ReferenceCropper:
+    """The original per offset crop loops, which Cropper must match exactly."""
+
+    def __init__(self, width: int, height: int, faces: list[Face], aspect_ratio):
+        self.width = width
+        self.height = height
+        self.faces = faces
+        self.aspect_ratio = aspect_ratio
+        (self.target_width, self.target_height), self.direction = self.crop_rect()
+
+    def crop_rect(self):
+        target_w, target_h = self.aspect_ratio
+
+        crop_w = min(self.width, int(self.height * target_w / target_h))
+        crop_h = min(self.height, int(self.width * target_h / target_w))
+
+        if crop_w * target_h > crop_h * target_w:
+            ret = crop_w, crop_h
+        else:
+            ret = (int(crop_h * target_w / target_h), crop_h)
+        return (ret, "y" if ret[0] == self.width else "x")
+
+    def clamp(self, val) -> Face:
+        min_ = int(val)
+
+        if self.direction == "x":
+            max_ = min_ + self.target_width
+            if min_ < 0:
+                return Face(xmin=0, ymin=0, xmax=self.target_width, ymax=self.height)
+            elif max_ > self.width:
+                return Face(
+                    ymin=0,
+                    xmin=self.width - self.target_width,
+                    xmax=self.width,
+                    ymax=self.height,
+                )
+            else:
+                return Face(ymin=0, xmin=min_, xmax=max_, ymax=self.height)
+        else:
+            max_ = min_ + self.target_height
+            if min_ < 0:
+                return Face(xmin=0, ymin=0, ymax=self.target_height, xmax=self.width)
+            elif max_ > self.height:
+                return Face(
+                    xmin=0,
+                    ymin=self.height - self.target_height,
+                    xmax=self.width,
+                    ymax=self.height,
+                )
+            else:
+                return Face(xmin=0, ymin=min_, ymax=max_, xmax=self.width)
+
+    def crop_single_face(self):
+        face = self.faces[0]
+        face_mid = (face[f"{self.direction}min"] + face[f"{self.direction}max"]) / 2
+        target = (
+            face_mid - self.target_width / 2
+            if self.direction == "x"
+            else face_mid - self.target_height / 2
+        )
+        return self.clamp(target)
+
+    def iter_image_slices(self):
+        for rect_start in range(
+            self.width - self.target_width
+            if self.direction == "x"
+            else self.height - self.target_height
+        ):
+            rect_end = rect_start + (
+                self.target_width if self.direction == "x" else self.target_height
+            )
+            yield rect_start, rect_end
+
+    def crop(self) -> Face:
+        if self.width == self.target_width and self.height == self.target_height:
+            return Face(xmin=0, xmax=self.width, ymin=0, ymax=self.height)
+
+        if not self.faces:
+            if self.direction == "x":
+                xmin = (self.width - self.target_width) // 2
+                return Face(
+                    xmin=xmin, xmax=xmin + self.target_width, ymin=0, ymax=self.height
+                )
+            ymin = (self.height - self.target_height) // 2
+            return Face(
+                xmin=0, xmax=self.width, ymin=ymin, ymax=ymin + self.target_height
+            )
+
+        if len(self.faces) == 1:
+            return self.crop_single_face()
+
+        min_ = "xmin" if self.direction == "x" else "ymin"
+        max_ = "xmax" if self.direction == "x" else "ymax"
+        faces = sorted(self.faces, key=lambda f: f[min_])
+
+        max_faces = 0
+        faces_info: list[FaceIntersections] = []
+        for rect_start, rect_end in self.iter_image_slices():
+            num_faces = 0
+            faces_area = 0
+            for face in faces:
+                if face[min_] > rect_end:
+                    break
+                elif face[max_] < rect_start:
+                    continue
+                elif face[min_] >= rect_start and face[max_] <= rect_end:
+                    num_faces += 1
+                    faces_area += (face["xmax"] - face["xmin"]) * (
+                        face["ymax"] - face["ymin"]
+                    )
+                    continue
+
+                if face[min_] <= rect_end and face[max_] > rect_end:
+                    num_faces += (rect_end - face[min_]) / (face[max_] - face[min_])
+                    if self.direction == "x":
+                        faces_area += (rect_end - face[min_]) * (
+                            face["ymax"] - face["ymin"]
+                        )
+                    else:
+                        faces_area += (rect_end - face[min_]) * (
+                            face["xmax"] - face["xmin"]
+                        )
+
+            if num_faces > 0:
+                if num_faces > max_faces:
+                    max_faces = num_faces
+                    faces_info = [FaceIntersections(faces_area, rect_start)]
+                elif num_faces == max_faces:
+                    faces_info.append(FaceIntersections(faces_area, rect_start))
+
+        faces_info.sort()
+        max_face_area = faces_info[-1].area
+        faces_info = [face for face in faces_info if face.area == max_face_area]
+        return self.clamp(faces_info[len(faces_info) // 2].start)
+
+    def crop_candidates(self) -> list[Face]:
+        if len(self.faces) == 1:
+            return [self.crop_single_face()]
+
+        min_ = "xmin" if self.direction == "x" else "ymin"
+        max_ = "xmax" if self.direction == "x" else "ymax"
+        faces = sorted(self.faces, key=lambda f: f[min_])
+
+        faces_info: list[FaceIntersections] = []
+        for rect_start, rect_end in self.iter_image_slices():
+            for face in faces:
+                if face[min_] > rect_end:
+                    break
+                elif face[max_] < rect_start:
+                    continue
+                elif face[min_] >= rect_start and face[max_] <= rect_end:
+                    faces_area = (face["xmax"] - face["xmin"]) * (
+                        face["ymax"] - face["ymin"]
+                    )
+                    faces_info.append(FaceIntersections(faces_area, rect_start))
+
+        faces_info.sort()
+        faces_by_area = defaultdict(list)
+        for face_info in faces_info:
+            faces_by_area[face_info.area].append(face_info.start)
+
+        return sorted(
+            [self.clamp(starts[len(starts) // 2]) for starts in faces_by_area.values()],
+            key=lambda r: r[min_],
+        )
+
+
+def random_layout(rng: random.Random, max_size: int) -> tuple[int, int, list[Face]]:
+    """
+    Random image size and faces, including duplicated, degenerate and out of
+    bounds faces.
+    """
+    width, height = rng.randint(50, max_size), rng.randint(50, max_size)
+    faces = []
+    for _ in range(rng.choice([0, 1, 2, 2, 3, 4, 5, 8, 12])):
+        if faces and rng.random() < 0.2:
+            faces.append(dict(rng.choice(faces)))
+            continue
+
+        face_w = rng.randint(0, width // 2 if rng.random() < 0.9 else width)
+        face_h = rng.randint(0, height // 2)
+        x, y = rng.randint(0, width - face_w), rng.randint(0, height - face_h)
+        # detections can extend past the image
+        if rng.random() < 0.1:
+            x += rng.randint(-face_w, face_w)
+            y += rng.randint(-face_h, face_h)
+        faces.append(Face(xmin=x, ymin=y, xmax=x + face_w, ymax=y + face_h))
+    return width, height, faces
+
+
+def test_crop_matches_reference():
+    rng = random.Random(0)
+    for _ in range(500):
+        width, height, faces = random_layout(rng, 1500)
+        for ratio in RATIOS:
+            expected = ReferenceCropper(width, height, faces, ratio).crop()
+            assert Cropper((width, height), faces, ratio).crop() == expected, (
+                width,
+                height,
+                faces,
+                ratio,
+            )
+
+
+def test_crop_candidates_matches_reference():
+    rng = random.Random(1)
+    for _ in range(3000):
+        # the reference is much slower for candidates, keep the images small
+        width, height, faces = random_layout(rng, 600)
+        ratio = rng.choice(RATIOS)
+        expected = ReferenceCropper(width, height, faces, ratio).crop_candidates()
+        assert Cropper((width, height), faces, ratio).crop_candidates() == expected, (
+            width,
+            height,
+            faces,
+            ratio,
+        )
@@ -0,0 +1,40 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import WALLPAPER_DIR, add_profile_argument, enable_profiling, iter_images
+from viewer import get_thumbnail_cache
+
+# creates the thumbnails used by preview.py and choose.py ahead of time
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # decoding and encoding release the gil, so threads are enough
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    enable_profiling(args)
+
+    thumbnails = get_thumbnail_cache()
+    paths = sorted(iter_images(WALLPAPER_DIR))
+
+    def warm(path) -> bool | None:
+        """Returns whether the thumbnail was created, or None if it failed."""
+        if path in thumbnails:
+            return False
+        try:
+            thumbnails.create(path)
+        except Exception as e:
+            print(f"{path}: {e}")
+            return None
+        return True
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as executor:
+        results = list(executor.map(warm, paths))
+
+    created = results.count(True)
+    failed = results.count(None)
+    print(
+        f"created {created} thumbnails, {results.count(False)} already cached, "
+        f"{failed} failed, in {time.perf_counter() - start:.2f}s"
+    )
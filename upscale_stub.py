@@ -0,0 +1,34 @@
+import argparse
+import os
+from pathlib import Path
+from PIL import Image
+
+# CPU only stand-in for realcugan-ncnn-vulkan that resizes with PIL, accepts the same
+# arguments for both single images and directories
+
+
+def upscale(input: Path, output: Path, scale: int):
+    image = Image.open(input)
+    image.resize((image.width * scale, image.height * scale), Image.LANCZOS).save(
+        output
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", type=Path, required=True)
+    parser.add_argument("-o", type=Path, required=True)
+    parser.add_argument("-s", type=int, default=2)
+    parser.add_argument("-f", default="png")
+    args = parser.parse_args()
+
+    if args.i.is_dir():
+        args.o.mkdir(parents=True, exist_ok=True)
+        for entry in sorted(os.scandir(args.i), key=lambda e: e.name):
+            # like realcugan, only regular files are read, not symlinks
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            path = Path(entry.path)
+            upscale(path, args.o / f"{path.stem}.{args.f}", args.s)
+    else:
+        upscale(args.i, args.o, args.s)
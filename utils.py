@@ -1,17 +1,46 @@
+import atexit
+import cProfile
+import contextlib
+import functools
+import hashlib
 import cv2
 import csv
 import json
+import os
+import re
+import shlex
+import sqlite3
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import detect_worker
+import numpy as np
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from typing import TypedDict, NamedTuple, Any
+from PIL import Image
 
 
 WALLPAPER_DIR = Path("~/Pictures/Wallpapers").expanduser()
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "waifu-crop"
+)
+CONFIG_DIR = (
+    Path(os.environ.get("XDG_CONFIG_HOME", "~/.config")).expanduser() / "waifu-crop"
+)
+# {"r1440x2560": "~/Pictures/WallpapersVertical", ...}
+RATIOS_CONFIG = CONFIG_DIR / "ratios.json"
 
 VERT_WALLPAPER_DIR = Path("~/Pictures/WallpapersVertical").expanduser()
 FRAMEWORK_WALLPAPER_DIR = Path("~/Pictures/WallpapersFramework").expanduser()
+ULTRAWIDE_WALLPAPER_DIR = Path("~/Pictures/WallpapersUltrawide").expanduser()
+HD_WALLPAPER_DIR = Path("~/Pictures/WallpapersHD").expanduser()
+SQUARE_WALLPAPER_DIR = Path("~/Pictures/WallpapersSquare").expanduser()
 
 Dimensions = tuple[int, int]
 AspectRatio = tuple[int, int]
@@ -22,16 +51,243 @@ VERTICAL_ASPECT_RATIO: AspectRatio = (1440, 2560)
 FRAMEWORK_ASPECT_RATIO: AspectRatio = (2256, 1504)
 SQUARE_ASPECT_RATIO: AspectRatio = (1, 1)
 
-CSV_FIELDS = (
-    "filename",
-    "faces",
-    "r1440x2560",
-    "r2256x1504",
-    "r3440x1440",
-    "r1920x1080",
-    "r1x1",
-    "wallust",
-)
+EXIF_ORIENTATION = 0x0112
+
+# output directories for cropped wallpapers of each aspect ratio, unless configured
+DEFAULT_RATIO_WALLPAPER_DIRS: dict[AspectRatio, Path] = {
+    VERTICAL_ASPECT_RATIO: VERT_WALLPAPER_DIR,
+    FRAMEWORK_ASPECT_RATIO: FRAMEWORK_WALLPAPER_DIR,
+    ULTRAWIDE_ASPECT_RATIO: ULTRAWIDE_WALLPAPER_DIR,
+    HD_ASPECT_RATIO: HD_WALLPAPER_DIR,
+    SQUARE_ASPECT_RATIO: SQUARE_WALLPAPER_DIR,
+}
+
+
+def load_ratios(path: Path = RATIOS_CONFIG) -> dict[AspectRatio, Path]:
+    try:
+        config = json.loads(path.read_text())
+    except FileNotFoundError:
+        return dict(DEFAULT_RATIO_WALLPAPER_DIRS)
+
+    return {
+        parse_ratio_str(ratio): Path(out_dir).expanduser()
+        for ratio, out_dir in config.items()
+    }
+
+
+def save_ratios(ratio_dirs: dict[AspectRatio, Path], path: Path = RATIOS_CONFIG):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        json.dumps(
+            {ratio_str(ratio): str(out_dir) for ratio, out_dir in ratio_dirs.items()},
+            indent=2,
+        )
+    )
+
+
+def ratio_str(ratio: AspectRatio) -> str:
+    return f"r{ratio[0]}x{ratio[1]}"
+
+
+def parse_ratio_str(ratio: str) -> AspectRatio:
+    w, h = ratio.lstrip("r").split("x")
+    return int(w), int(h)
+
+
+def is_ratio_column(column: str) -> bool:
+    return re.fullmatch(r"r\d+x\d+", column) is not None
+
+
+# output directories for cropped wallpapers of each aspect ratio
+RATIO_WALLPAPER_DIRS = load_ratios()
+# aspect ratios stored for each wallpaper
+GEOMETRY_RATIOS: list[AspectRatio] = list(RATIO_WALLPAPER_DIRS)
+
+
+def wallpaper_fields(ratio_columns) -> tuple[str, ...]:
+    """Columns of the metadata, the geometry of each ratio is in its own column."""
+    return (
+        "filename",
+        "faces",
+        *ratio_columns,
+        "wallust",
+        "width",
+        "height",
+        "dhash",
+    )
+
+
+# faces are stored as (N, 4) arrays with these columns, as little endian int32 blobs
+FACE_COLUMNS = ("xmin", "xmax", "ymin", "ymax")
+FACES_DTYPE = np.dtype("<i4")
+
+# perceptual hashes are compared on a DHASH_SIZE x DHASH_SIZE grid, images within
+# DUPLICATE_DISTANCE differing bits are considered the same wallpaper
+DHASH_SIZE = 8
+DUPLICATE_DISTANCE = 4
+
+
+class Profiler:
+    """
+    Collects timings and counters of the slow parts of a run, e.g. face detection,
+    decoding images and external commands. Disabled unless the WAIFU_CROP_PROFILE
+    environment variable or --profile is set:
+
+    - 1: prints a summary at exit
+    - a .json path: also writes a trace, viewable in chrome://tracing or perfetto
+    - a .prof path: also writes a cProfile dump of the main thread
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.output: Path | None = None
+        self.timings: defaultdict[str, list[float]] = defaultdict(list)
+        self.counters: defaultdict[str, int] = defaultdict(int)
+        # (name, start, duration, thread id) for the json trace
+        self.events: list[tuple[str, float, float, int]] = []
+        self.profile: cProfile.Profile | None = None
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def enable(self, output: str = "1"):
+        if self.enabled:
+            return
+
+        self.enabled = True
+        self.start = time.perf_counter()
+        if output != "1":
+            self.output = Path(output)
+        if self.output and self.output.suffix == ".prof":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        _wrap_timed()
+        atexit.register(self.report)
+
+    @contextlib.contextmanager
+    def _timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timings[name].append(elapsed)
+                if self.output:
+                    self.events.append(
+                        (name, start, elapsed, threading.get_native_id())
+                    )
+
+    def timer(self, name: str):
+        """Context manager that records how long its block takes under name."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timer(name)
+
+    def count(self, name: str, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += n
+
+    def summary(self) -> str:
+        lines = [
+            f"{'stage':<20} {'count':>7} {'total':>9} {'p50':>9} {'p95':>9} {'max':>9}"
+        ]
+        for name, times in sorted(self.timings.items()):
+            times = sorted(times)
+            lines.append(
+                f"{name:<20} {len(times):>7} {sum(times):>8.3f}s "
+                f"{times[len(times) // 2]:>8.4f}s "
+                f"{times[int(len(times) * 0.95)]:>8.4f}s {times[-1]:>8.4f}s"
+            )
+        for name, count in sorted(self.counters.items()):
+            lines.append(f"{name:<20} {count:>7}")
+        return "\n".join(lines)
+
+    def report(self):
+        print(self.summary(), file=sys.stderr)
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.output)
+        elif self.output:
+            pid = os.getpid()
+            self.output.write_text(
+                json.dumps(
+                    {
+                        "traceEvents": [
+                            {
+                                "name": name,
+                                "ph": "X",
+                                "ts": (start - self.start) * 1e6,
+                                "dur": duration * 1e6,
+                                "pid": pid,
+                                "tid": tid,
+                            }
+                            for name, start, duration, tid in self.events
+                        ]
+                    }
+                )
+            )
+        if self.output:
+            print(f"wrote profile to {self.output}", file=sys.stderr)
+
+
+PROFILER = Profiler()
+# (stage name, function) of timed methods, wrapped once profiling is enabled
+_TIMED: list[tuple[str, Any]] = []
+
+
+def _timed_wrapper(name: str, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with PROFILER._timer(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def timed(name: str):
+    """
+    Decorator for methods that records the time of each call when profiling is
+    enabled. The method is only replaced by a wrapper once profiling is enabled, so
+    there is no overhead otherwise.
+    """
+
+    def decorator(func):
+        if PROFILER.enabled:
+            return _timed_wrapper(name, func)
+        _TIMED.append((name, func))
+        return func
+
+    return decorator
+
+
+def _wrap_timed():
+    for name, func in _TIMED:
+        class_name, attr = func.__qualname__.rsplit(".", 1)
+        cls = getattr(sys.modules[func.__module__], class_name)
+        setattr(cls, attr, _timed_wrapper(name, func))
+    _TIMED.clear()
+
+
+if os.environ.get("WAIFU_CROP_PROFILE"):
+    PROFILER.enable(os.environ["WAIFU_CROP_PROFILE"])
+
+
+def add_profile_argument(parser):
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="1",
+        metavar="OUTPUT",
+        help="print timings at exit, optionally writing a .json trace or .prof dump",
+    )
+
+
+def enable_profiling(args):
+    """Enables profiling if requested by --profile, see add_profile_argument."""
+    if args.profile:
+        PROFILER.enable(args.profile)
 
 
 class Face(TypedDict):
@@ -41,9 +297,68 @@ class Face(TypedDict):
     ymax: int
 
 
+class ManifestEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    hash: str
+
+
 class FaceIntersections(NamedTuple):
     area: int
     start: int
+    # number of consecutive starts with the same area
+    count: int = 1
+
+
+def tuple_to_face(face) -> Face:
+    """Faces are stored as (xmin, xmax, ymin, ymax), see FACE_COLUMNS"""
+    if isinstance(face, dict):
+        return Face(
+            xmin=face["xmin"], ymin=face["ymin"], xmax=face["xmax"], ymax=face["ymax"]
+        )
+
+    xmin, xmax, ymin, ymax = face
+    return Face(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+
+
+def faces_array(faces) -> np.ndarray:
+    """
+    Converts faces to an (N, 4) int32 array with the FACE_COLUMNS. faces can be Face
+    dicts, (xmin, xmax, ymin, ymax) tuples or already an array.
+    """
+    if isinstance(faces, np.ndarray):
+        return faces.astype(np.int32, copy=False).reshape(-1, 4)
+
+    return np.array(
+        [
+            [face[col] for col in FACE_COLUMNS] if isinstance(face, dict) else face
+            for face in faces
+        ],
+        dtype=np.int32,
+    ).reshape(-1, 4)
+
+
+def faces_to_dicts(faces: np.ndarray) -> list[Face]:
+    return [tuple_to_face(face) for face in faces.tolist()]
+
+
+def faces_to_blob(faces) -> bytes:
+    return faces_array(faces).astype(FACES_DTYPE, copy=False).tobytes()
+
+
+def faces_to_json(blob: bytes) -> str:
+    """Faces blob as a json list of (xmin, xmax, ymin, ymax), like the csv."""
+    # formatting directly is much faster than numpy and json for a few faces
+    return (
+        "["
+        + ",".join("[%d,%d,%d,%d]" % face for face in struct.iter_unpack("<4i", blob))
+        + "]"
+    )
+
+
+def blob_to_faces(blob: bytes) -> np.ndarray:
+    """The returned array is read only, as it shares memory with the blob."""
+    return np.frombuffer(blob, dtype=FACES_DTYPE).reshape(-1, 4)
 
 
 def box_to_geometry(face: Face) -> str:
@@ -55,72 +370,377 @@ def box_to_geometry(face: Face) -> str:
     return f"{w}x{h}+{x}+{y}"
 
 
+def geometry_to_box(geometry: str) -> Face:
+    # split geometry into width, height, x, y
+    w, h, x, y = [
+        int(n)
+        for n in geometry.lstrip("r").replace("x", " ").replace("+", " ").split(" ")
+    ]
+
+    return Face(xmin=x, ymin=y, xmax=x + w, ymax=y + h)
+
+
 class WallpaperInfo:
+    """
+    Wallpaper metadata, stored in a sqlite database so that single rows can be
+    updated without rewriting everything. The database is imported from
+    wallpapers.csv on first use, and can be exported back to it with export_csv().
+
+    Rows are only read from the database when accessed, rows of deleted wallpapers
+    are removed by prune().
+    """
+
     def __init__(self):
-        self.path = WALLPAPER_DIR / "wallpapers.csv"
-        try:
-            loaded = {}
-            csvfile = open(self.path)
-            csvfile.readline()  # Read and discard the header
-            for wall in csv.DictReader(csvfile, fieldnames=CSV_FIELDS):
-                loaded[wall["filename"]] = {
-                    **wall,
-                    # use ast eval to convert string to list
-                    "faces": json.loads(wall["faces"]),
-                }
-        except FileNotFoundError:
-            loaded = {}
+        self.path = WALLPAPER_DIR / "wallpapers.db"
+        self.csv_path = WALLPAPER_DIR / "wallpapers.csv"
+
+        is_new = not self.path.exists()
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        # keep the journal between commits instead of deleting it, so that commits
+        # do not modify the wallpaper directory, see prune()
+        self.conn.execute("PRAGMA journal_mode=PERSIST")
+        ratio_columns = [ratio_str(ratio) for ratio in GEOMETRY_RATIOS]
+        columns = ", ".join(
+            f"{field} TEXT" for field in wallpaper_fields(ratio_columns)[1:]
+        )
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS wallpapers "
+            f"(filename TEXT PRIMARY KEY, {columns})"
+        )
+        existing = [
+            row["name"] for row in self.conn.execute("PRAGMA table_info(wallpapers)")
+        ]
+        # geometries of ratios that are no longer configured are kept
+        ratio_columns += [
+            column
+            for column in existing
+            if is_ratio_column(column) and column not in ratio_columns
+        ]
+        self.fields = wallpaper_fields(ratio_columns)
+        self.fields_sql = ", ".join(self.fields)
+        # add columns for fields and ratios added since the database was created
+        self.add_columns(self.fields)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest (filename TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL)"
+        )
+        if is_new and self.csv_path.exists():
+            self.import_csv(self.csv_path)
+        self.convert_json_faces()
 
-        # cleanup files that have been deleted
+        # rows that have been read from the database
         self.data = {}
-        for img in iter_images(WALLPAPER_DIR):
-            fname = img.name
-
-            if fname in loaded:
-                self.data[fname] = loaded[fname]
+        # rows that might have been modified since the last save
+        self.dirty = set()
+
+    def add_columns(self, fields):
+        existing = {
+            row["name"] for row in self.conn.execute("PRAGMA table_info(wallpapers)")
+        }
+        for field in fields:
+            if field not in existing:
+                self.conn.execute(f"ALTER TABLE wallpapers ADD COLUMN {field} TEXT")
+
+    def convert_json_faces(self):
+        """Converts faces stored as json by older versions to blobs."""
+        rows = self.conn.execute(
+            "SELECT filename, faces FROM wallpapers WHERE typeof(faces) = 'text'"
+        ).fetchall()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE wallpapers SET faces = ? WHERE filename = ?",
+                [
+                    (faces_to_blob(json.loads(faces) if faces else []), fname)
+                    for fname, faces in rows
+                ],
+            )
 
-    def __getitem__(self, key):
+    @staticmethod
+    def row_to_wall(row) -> dict:
+        return {
+            **row,
+            "faces": blob_to_faces(row["faces"] or b""),
+            "width": int(row["width"]) if row["width"] else None,
+            "height": int(row["height"]) if row["height"] else None,
+        }
+
+    def wall_to_row(self, fname, wall) -> tuple:
+        row = {
+            **wall,
+            "filename": fname,
+            "faces": faces_to_blob(wall["faces"]),
+        }
+        return tuple(row.get(field) for field in self.fields)
+
+    def load(self, key) -> dict | None:
         if key not in self.data:
-            return self.data[key.replace(".jpg", ".png")]
+            row = self.conn.execute(
+                f"SELECT {self.fields_sql} FROM wallpapers WHERE filename = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.data[key] = self.row_to_wall(row)
         return self.data[key]
 
+    def __getitem__(self, key):
+        if key not in self:
+            key = key.replace(".jpg", ".png")
+
+        wall = self.load(key)
+        if wall is None:
+            raise KeyError(key)
+        # the returned row can be modified in place
+        self.dirty.add(key)
+        return wall
+
     def __setitem__(self, key, value):
         self.data[key] = value
+        self.dirty.add(key)
 
     def __contains__(self, key):
-        return key in self.data
+        return key in self.data or (
+            self.conn.execute(
+                "SELECT 1 FROM wallpapers WHERE filename = ?", (key,)
+            ).fetchone()
+            is not None
+        )
 
+    def keys(self) -> list[str]:
+        saved = [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT filename FROM wallpapers ORDER BY filename"
+            )
+        ]
+        return sorted(set(saved).union(self.data))
+
+    def items(self):
+        # read all rows at once instead of one query per row
+        for row in self.conn.execute(f"SELECT {self.fields_sql} FROM wallpapers"):
+            if row["filename"] not in self.data:
+                self.data[row["filename"]] = self.row_to_wall(row)
+
+        # rows are not marked as modified, use __getitem__ / __setitem__ for that
+        for fname in sorted(self.data):
+            yield fname, self.data[fname]
+
+    def backfill_dimensions(self):
+        """Stores the dimensions of wallpapers saved before they were recorded."""
+        for fname, wall in self.items():
+            if wall.get("width") and wall.get("height"):
+                continue
+
+            try:
+                wall["width"], wall["height"] = image_size(WALLPAPER_DIR / fname)
+            except FileNotFoundError:
+                continue
+            self.dirty.add(fname)
+        self.save()
+
+    @timed("save")
     def save(self):
-        with open(self.path, "w") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDS)
-            writer.writeheader()
-            for wall in self.data.values():
-                writer.writerow(
-                    {
-                        **wall,
-                        # minimize whitespace
-                        "faces": json.dumps(wall["faces"], separators=(",", ":")),
-                    }
+        """Writes modified rows in a single transaction."""
+        placeholders = ", ".join("?" for _ in self.fields)
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO wallpapers ({self.fields_sql}) "
+                f"VALUES ({placeholders})",
+                [self.wall_to_row(fname, self.data[fname]) for fname in self.dirty],
+            )
+        self.dirty.clear()
+
+    def prune(self, incremental=True):
+        """
+        Removes rows of wallpapers that have been deleted. If incremental, the
+        directory is only scanned when it has been modified since the last prune.
+        """
+        dir_mtime = WALLPAPER_DIR.stat().st_mtime_ns
+        if incremental and self.pruned_mtime() == dir_mtime:
+            return
+
+        existing = {img.name for img in iter_images(WALLPAPER_DIR)}
+        self.delete([fname for fname in self.keys() if fname not in existing])
+        self.set_pruned_mtime(dir_mtime)
+
+    def pruned_mtime(self) -> int | None:
+        """The modified time of the wallpaper directory when it was last pruned."""
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'pruned_mtime'"
+        ).fetchone()
+        return int(row[0]) if row is not None else None
+
+    def set_pruned_mtime(self, dir_mtime: int):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('pruned_mtime', ?)",
+                (str(dir_mtime),),
+            )
+
+    def delete(self, fnames: list[str]):
+        """Removes the rows and manifest entries of the wallpapers."""
+        with self.conn:
+            for table in ("wallpapers", "manifest"):
+                self.conn.executemany(
+                    f"DELETE FROM {table} WHERE filename = ?",
+                    [(fname,) for fname in fnames],
+                )
+
+        for fname in fnames:
+            self.data.pop(fname, None)
+            self.dirty.discard(fname)
+
+    def manifest(self) -> dict[str, ManifestEntry]:
+        """The (size, mtime, content hash) of each wallpaper when it was processed."""
+        return {
+            row[0]: ManifestEntry(*row[1:])
+            for row in self.conn.execute(
+                "SELECT filename, size, mtime_ns, hash FROM manifest"
+            )
+        }
+
+    def update_manifest(self, entries: dict[str, ManifestEntry]):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)",
+                [(fname, *entry) for fname, entry in entries.items()],
+            )
+
+    def import_csv(self, path: Path):
+        with open(path) as csvfile:
+            reader = csv.DictReader(csvfile)
+            walls = list(reader)
+        # keep the geometries of ratios that are not configured
+        ratio_columns = [field for field in self.fields if is_ratio_column(field)]
+        ratio_columns += [
+            field
+            for field in reader.fieldnames or []
+            if is_ratio_column(field) and field not in ratio_columns
+        ]
+        self.fields = wallpaper_fields(ratio_columns)
+        self.fields_sql = ", ".join(self.fields)
+        self.add_columns(self.fields)
+
+        placeholders = ", ".join("?" for _ in self.fields)
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO wallpapers ({self.fields_sql}) "
+                f"VALUES ({placeholders})",
+                (
+                    tuple(
+                        (
+                            faces_to_blob(json.loads(wall["faces"] or "[]"))
+                            if field == "faces"
+                            else wall.get(field)
+                        )
+                        for field in self.fields
+                    )
+                    for wall in walls
+                ),
+            )
+
+    def missing_ratios(self) -> list[AspectRatio]:
+        """
+        Configured ratios that have not been computed for every wallpaper yet, e.g.
+        newly added ones. Ratios found to be complete are remembered in the meta
+        table, so they are only checked once.
+        """
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'complete_ratios'"
+        ).fetchone()
+        complete = set(json.loads(row[0])) if row else set()
+
+        missing = []
+        for ratio in GEOMETRY_RATIOS:
+            column = ratio_str(ratio)
+            if column in complete:
+                continue
+
+            (incomplete,) = self.conn.execute(
+                f"SELECT EXISTS(SELECT 1 FROM wallpapers "
+                f"WHERE COALESCE({column}, '') = '')"
+            ).fetchone()
+            if incomplete:
+                missing.append(ratio)
+            else:
+                complete.add(column)
+
+        # ratios that are removed and added again need to be checked again
+        complete &= {ratio_str(ratio) for ratio in GEOMETRY_RATIOS}
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('complete_ratios', ?)",
+                (json.dumps(sorted(complete)),),
+            )
+        return missing
+
+    def dhash_index(self) -> "HashIndex":
+        """Index of the perceptual hashes of the saved wallpapers, by filename."""
+        index = HashIndex()
+        for fname, digest in self.conn.execute(
+            "SELECT filename, dhash FROM wallpapers WHERE COALESCE(dhash, '') != ''"
+        ):
+            index.add(int(digest, 16), fname)
+        return index
+
+    def export_csv(self, path: Path | None = None):
+        """Writes the saved rows as csv, replacing the file only once complete."""
+        path = path or self.csv_path
+        # replacing the csv modifies the directory, which should not count as a
+        # change to the wallpapers if it was pruned before
+        dir_mtime = path.parent.stat().st_mtime_ns
+        is_pruned = path.parent == WALLPAPER_DIR and self.pruned_mtime() == dir_mtime
+        tmp_path = path.with_name(f".{path.stem}.tmp{path.suffix}")
+        with open(tmp_path, "w") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(self.fields)
+            cursor = self.conn.cursor()
+            cursor.row_factory = None
+            # faces are written as json, like the rest of the row
+            writer.writerows(
+                (fname, faces_to_json(faces or b""), *rest)
+                for fname, faces, *rest in cursor.execute(
+                    f"SELECT {self.fields_sql} FROM wallpapers ORDER BY filename"
                 )
+            )
+        os.replace(tmp_path, path)
+        if is_pruned:
+            self.set_pruned_mtime(WALLPAPER_DIR.stat().st_mtime_ns)
 
 
 @dataclass
 class Cropper:
     image: Any
-    faces: list[Face]
+    boxes: np.ndarray
     aspect_ratio: AspectRatio = (9, 16)
 
     def __init__(
         self,
         image,
-        faces: list[Face],
+        faces,
         aspect_ratio: AspectRatio = (9, 16),
     ):
+        """
+        image is either a numpy image, or just its (width, height) when the pixels
+        are not needed, see image_size(). faces can be anything faces_array() accepts.
+        """
         self.image = image
-        self.faces = faces
-        self.height, self.width = self.image.shape[:2]
+        self.boxes = faces_array(faces)
+        if isinstance(image, tuple):
+            self.width, self.height = image
+        else:
+            self.height, self.width = self.image.shape[:2]
+        # faces sorted by xmin / ymin, shared between aspect ratios
+        self._sorted_faces: dict[str, list[list[int]]] = {}
         self.set_aspect_ratio(aspect_ratio)
 
+    @property
+    def faces(self) -> list[Face]:
+        return faces_to_dicts(self.boxes)
+
     def set_aspect_ratio(self, aspect_ratio: AspectRatio):
         self.aspect_ratio = aspect_ratio
         (self.target_width, self.target_height), self.direction = self.crop_rect()
@@ -142,6 +762,10 @@ class Cropper:
             )
         return (ret, "y" if ret[0] == self.width else "x")
 
+    def columns(self) -> tuple[int, int]:
+        """Columns of the (min, max) of the faces in the crop direction."""
+        return (0, 1) if self.direction == "x" else (2, 3)
+
     def clamp(self, val) -> Face:
         min_ = int(val)
 
@@ -174,8 +798,9 @@ class Cropper:
                 return Face(xmin=0, ymin=min_, ymax=max_, xmax=self.width)
 
     def crop_single_face(self):
-        face = self.faces[0]
-        face_mid = (face[f"{self.direction}min"] + face[f"{self.direction}max"]) / 2
+        min_, max_ = self.columns()
+        face = self.boxes[0].tolist()
+        face_mid = (face[min_] + face[max_]) / 2
         target = (
             face_mid - self.target_width / 2
             if self.direction == "x"
@@ -184,17 +809,7 @@ class Cropper:
 
         return self.clamp(target)
 
-    def iter_image_slices(self):
-        for rect_start in range(
-            self.width - self.target_width
-            if self.direction == "x"
-            else self.height - self.target_height
-        ):
-            rect_end = rect_start + (
-                self.target_width if self.direction == "x" else self.target_height
-            )
-            yield rect_start, rect_end
-
+    @timed("crop")
     def crop(self) -> Face:
         # crop area is the entire image
         if self.width == self.target_width and self.height == self.target_height:
@@ -205,7 +820,7 @@ class Cropper:
                 "ymax": self.height,
             }
 
-        if not self.faces:
+        if not len(self.boxes):
             # return the center of the image
             if self.direction == "x":
                 xmin = (self.width - self.target_width) // 2
@@ -224,60 +839,60 @@ class Cropper:
                     "ymax": ymin + self.target_height,
                 }
 
-        if len(self.faces) == 1:
+        if len(self.boxes) == 1:
             return self.crop_single_face()
 
-        min_ = "xmin" if self.direction == "x" else "ymin"
-        max_ = "xmax" if self.direction == "x" else "ymax"
+        min_, max_ = self.columns()
+        target = self.target_width if self.direction == "x" else self.target_height
+        num_slices = max(
+            (self.width if self.direction == "x" else self.height) - target, 0
+        )
 
-        # sort faces by min_
-        faces = sorted(self.faces, key=lambda f: f[min_])
+        faces = self.sorted_faces(self.direction)
+
+        # the faces covered by a slice only change when a face boundary enters or
+        # leaves it, so only the slices between these events need to be checked
+        events = {0, num_slices}
+        for face in faces:
+            for event in (face[min_] - target, face[max_] - target, face[min_] + 1):
+                if 0 < event < num_slices:
+                    events.add(event)
+        events = sorted(events)
 
         max_faces = 0
-        # (area, min_ of face)
+        # (area, min_ of slice, number of consecutive slices)
         faces_info: list[FaceIntersections] = []
 
-        for rect_start, rect_end in self.iter_image_slices():
-            # check number of faces in decimal within enclosed within larger rectangle
-            num_faces = 0
-            faces_area = 0
-            for face in faces:
-                # no intersection, we overshot the final face
-                if face[min_] > rect_end:
-                    break
-
-                # no intersection
-                elif face[max_] < rect_start:
-                    continue
-
-                # full intersection
-                elif face[min_] >= rect_start and face[max_] <= rect_end:
-                    num_faces += 1
-                    faces_area += (face["xmax"] - face["xmin"]) * (
-                        face["ymax"] - face["ymin"]
-                    )
-                    continue
+        for seg_start, seg_end in zip(events, events[1:]):
+            has_partial = any(
+                face[min_] - target <= seg_start < face[max_] - target for face in faces
+            )
 
-                # partial intersection
-                if face[min_] <= rect_end and face[max_] > rect_end:
-                    num_faces += (rect_end - face[min_]) / (face[max_] - face[min_])
-                    if self.direction == "x":
-                        faces_area += (rect_end - face[min_]) * (
-                            face["ymax"] - face["ymin"]
-                        )
-                    else:
-                        faces_area += (rect_end - face[min_]) * (
-                            face["xmax"] - face["xmin"]
-                        )
-                    continue
+            if has_partial:
+                # partial faces grow towards the end of the segment, so only the
+                # trailing slices can have the most faces
+                num_faces, _ = self.slice_coverage(faces, seg_end - 1)
+                seg_info = []
+                for rect_start in range(seg_end - 1, seg_start - 1, -1):
+                    slice_faces, faces_area = self.slice_coverage(faces, rect_start)
+                    if slice_faces != num_faces:
+                        break
+                    seg_info.append(FaceIntersections(faces_area, rect_start))
+                seg_info.reverse()
+            else:
+                # only fully enclosed faces, every slice in the segment is the same
+                num_faces, faces_area = self.slice_coverage(faces, seg_start)
+                seg_info = [
+                    FaceIntersections(faces_area, seg_start, seg_end - seg_start)
+                ]
 
             # update max faces
             if num_faces > 0:
                 if num_faces > max_faces:
                     max_faces = num_faces
-                    faces_info = [FaceIntersections(faces_area, rect_start)]
+                    faces_info = seg_info
                 elif num_faces == max_faces:
-                    faces_info.append(FaceIntersections(faces_area, rect_start))
+                    faces_info.extend(seg_info)
 
         faces_info.sort()
         # use the match with the maximum area of face coverage
@@ -285,76 +900,149 @@ class Cropper:
         faces_info = [face for face in faces_info if face.area == max_face_area]
 
         # get the midpoint of matches to center the face
-        return self.clamp(faces_info[len(faces_info) // 2].start)
-
-    def crop_candidates(self) -> list[Face]:
-        if len(self.faces) == 1:
-            return [self.crop_single_face()]
-
-        min_ = "xmin" if self.direction == "x" else "ymin"
-        max_ = "xmax" if self.direction == "x" else "ymax"
-
-        # sort faces by min_
-        faces = sorted(self.faces, key=lambda f: f[min_])
+        mid = sum(face.count for face in faces_info) // 2
+        for face in faces_info:
+            if mid < face.count:
+                return self.clamp(face.start + mid)
+            mid -= face.count
+
+    def slice_coverage(self, faces: list[list[int]], rect_start: int):
+        """
+        Number of faces (in decimal) and area of faces enclosed within the slice
+        starting at rect_start. Faces must be sorted, see sorted_faces().
+        """
+        min_, max_ = self.columns()
+        # the face size perpendicular to the crop direction
+        other_min, other_max = (2, 3) if self.direction == "x" else (0, 1)
+        rect_end = rect_start + (
+            self.target_width if self.direction == "x" else self.target_height
+        )
 
-        # (area, xmin of face)
-        faces_info: list[FaceIntersections] = []
+        num_faces = 0
+        faces_area = 0
+        for face in faces:
+            # no intersection, we overshot the final face
+            if face[min_] > rect_end:
+                break
+
+            # no intersection
+            elif face[max_] < rect_start:
+                continue
+
+            # full intersection
+            elif face[min_] >= rect_start and face[max_] <= rect_end:
+                num_faces += 1
+                faces_area += (face[1] - face[0]) * (face[3] - face[2])
+                continue
+
+            # partial intersection
+            if face[min_] <= rect_end and face[max_] > rect_end:
+                num_faces += (rect_end - face[min_]) / (face[max_] - face[min_])
+                faces_area += (rect_end - face[min_]) * (
+                    face[other_max] - face[other_min]
+                )
+                continue
 
-        for rect_start, rect_end in self.iter_image_slices():
-            # check number of faces in decimal within enclosed within larger rectangle
-            for face in faces:
-                # no intersection, we overshot the final face
-                if face[min_] > rect_end:
-                    break
+        return num_faces, faces_area
 
-                # no intersection
-                elif face[max_] < rect_start:
-                    continue
+    def crop_candidates(self, max_candidates: int | None = None) -> list[Face]:
+        """
+        One crop for each distinct face area, centered on the slices that fully
+        contain faces of that area. If there are more than max_candidates, the crops
+        for the largest faces are kept.
+        """
+        if len(self.boxes) == 1:
+            return [self.crop_single_face()]
 
-                # full intersection
-                elif face[min_] >= rect_start and face[max_] <= rect_end:
-                    faces_area = (face["xmax"] - face["xmin"]) * (
-                        face["ymax"] - face["ymin"]
-                    )
-                    faces_info.append(FaceIntersections(faces_area, rect_start))
-                    continue
+        min_, max_ = self.columns()
+        target = self.target_width if self.direction == "x" else self.target_height
+        num_slices = max(
+            (self.width if self.direction == "x" else self.height) - target, 0
+        )
 
-        faces_info.sort()
-        # group the faces by area
-        faces_by_area = defaultdict(list)
-        for face_info in faces_info:
-            faces_by_area[face_info.area].append(face_info.start)
+        # a face is fully contained by the contiguous range of slices that start
+        # between face[max_] - target and face[min_], group these ranges by area
+        ranges_by_area: defaultdict[int, list[tuple[int, int]]] = defaultdict(list)
+        for face in self.boxes.tolist():
+            first = max(face[max_] - target, 0)
+            last = min(face[min_], num_slices - 1)
+            if first <= last:
+                area = (face[1] - face[0]) * (face[3] - face[2])
+                ranges_by_area[area].append((first, last))
+
+        candidate_areas = sorted(ranges_by_area)
+        if max_candidates is not None:
+            candidate_areas = candidate_areas[
+                max(len(candidate_areas) - max_candidates, 0) :
+            ]
 
         return sorted(
             # get midpoints for each face
             [
-                self.clamp(starts[len(starts) // 2])
-                for _, starts in faces_by_area.items()
+                self.clamp(self.median_start(ranges_by_area[area]))
+                for area in candidate_areas
             ],
-            key=lambda r: r[min_],
+            key=lambda r: r["xmin" if self.direction == "x" else "ymin"],
         )
 
-    def faces_tuples(self):
-        return [(f["xmin"], f["xmax"], f["ymin"], f["ymax"]) for f in self.faces]
-
-    def geometries(self):
-        ret = {}
-
-        for ratio in [
-            VERTICAL_ASPECT_RATIO,
-            FRAMEWORK_ASPECT_RATIO,
-            ULTRAWIDE_ASPECT_RATIO,
-            HD_ASPECT_RATIO,
-            SQUARE_ASPECT_RATIO,
-        ]:
-            ratio_str = f"r{ratio[0]}x{ratio[1]}"
+    @staticmethod
+    def median_start(ranges: list[tuple[int, int]]) -> int:
+        """
+        Median of the slice starts within the (inclusive) ranges, counting starts
+        in overlapping ranges multiple times.
+        """
+        events: defaultdict[int, int] = defaultdict(int)
+        for first, last in ranges:
+            events[first] += 1
+            events[last + 1] -= 1
+
+        mid = sum(last - first + 1 for first, last in ranges) // 2
+        active = 0
+        points = sorted(events)
+        for point, next_point in zip(points, points[1:]):
+            active += events[point]
+            # each start between the points is counted active times
+            count = active * (next_point - point)
+            if mid < count:
+                return point + mid // active
+            mid -= count
 
+    def faces_tuples(self):
+        return [tuple(face) for face in self.boxes.tolist()]
+
+    def sorted_faces(self, direction: str) -> list[list[int]]:
+        """Faces as lists of FACE_COLUMNS, sorted by their min in the direction."""
+        if direction not in self._sorted_faces:
+            min_ = 0 if direction == "x" else 2
+            order = np.argsort(self.boxes[:, min_], kind="stable")
+            self._sorted_faces[direction] = self.boxes[order].tolist()
+        return self._sorted_faces[direction]
+
+    def crop_many(self, ratios: list[AspectRatio]) -> list[Face]:
+        """
+        Crops the image for multiple aspect ratios at once. Ratios resulting in the
+        same crop rectangle size are only computed once.
+        """
+        orig_ratio = self.aspect_ratio
+        boxes = {}
+
+        ret = []
+        for ratio in ratios:
             self.set_aspect_ratio(ratio)
-            box = self.crop()
-            ret[ratio_str] = box_to_geometry(box)
+            key = (self.direction, self.target_width, self.target_height)
+            if key not in boxes:
+                boxes[key] = self.crop()
+            ret.append(dict(boxes[key]))
 
+        self.set_aspect_ratio(orig_ratio)
         return ret
 
+    def geometries(self, ratios: list[AspectRatio] = GEOMETRY_RATIOS):
+        return {
+            ratio_str(ratio): box_to_geometry(box)
+            for ratio, box in zip(ratios, self.crop_many(ratios))
+        }
+
 
 def draw(image, faces, color=(0, 255, 0), thickness=1):
     """
@@ -374,26 +1062,767 @@ def draw(image, faces, color=(0, 255, 0), thickness=1):
     return image
 
 
-def detect(
-    image,
-) -> list[Face]:
-    # read output of terminal command `anime-face-detector img` as json
-    result = subprocess.run(
-        ["anime-face-detector", image], capture_output=True, text=True
+def file_key(image) -> str:
+    """Changes whenever the file is replaced or modified."""
+    path = Path(image).resolve()
+    stat = path.stat()
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def shared_instance(func):
+    """
+    Makes a function that creates an object return the same object on every call,
+    created on first use, also when first called from multiple threads at once.
+    """
+    lock = threading.Lock()
+    instances = []
+
+    @functools.wraps(func)
+    def wrapper():
+        with lock:
+            if not instances:
+                instances.append(func())
+        return instances[0]
+
+    return wrapper
+
+
+class CacheDB:
+    """
+    Sqlite database with a single table in the cache directory, which can be
+    shared between threads. Losing the last writes on a power failure is fine for
+    a cache, so commits are not synced to disk.
+    """
+
+    def __init__(self, path: Path, schema: str):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {schema}")
+
+
+class LRUCache(CacheDB):
+    """
+    Cache table of (key, *columns, accessed). Least recently used entries are
+    evicted once the total of size_sql over the entries exceeds max_bytes.
+    """
+
+    # seconds between updates of the access time of an entry, so lookups rarely
+    # need a write
+    ACCESS_RESOLUTION = 60
+
+    def __init__(
+        self, path: Path, table: str, columns: str, size_sql: str, max_bytes: int
+    ):
+        super().__init__(
+            path,
+            f"{table} (key TEXT PRIMARY KEY, {columns}, accessed REAL NOT NULL)",
+        )
+        self.table = table
+        self.size_sql = size_sql
+        self.max_bytes = max_bytes
+        # kept up to date by store and evict, instead of summing the table each time
+        self.size = self.total_size()
+
+    def total_size(self) -> int:
+        (size,) = self.conn.execute(
+            f"SELECT COALESCE(SUM({self.size_sql}), 0) FROM {self.table}"
+        ).fetchone()
+        return size
+
+    def lookup(self, key: str, columns: str) -> tuple | None:
+        """Returns the given columns of the entry, or None if not cached."""
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {columns}, accessed FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            *values, accessed = row
+            now = time.time()
+            if now - accessed > self.ACCESS_RESOLUTION:
+                with self.conn:
+                    self.conn.execute(
+                        f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                        (now, key),
+                    )
+        return tuple(values)
+
+    def store(self, key: str, values: tuple, size: int):
+        """Adds or replaces the entry, size is its size_sql."""
+        placeholders = ", ".join("?" for _ in values)
+        with self.lock:
+            replaced = self.conn.execute(
+                f"SELECT {self.size_sql} FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            with self.conn:
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} "
+                    f"VALUES (?, {placeholders}, ?)",
+                    (key, *values, time.time()),
+                )
+            self.size += size - (replaced[0] if replaced else 0)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def remove(self, key: str):
+        with self.lock:
+            with self.conn:
+                self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self.on_evict(key)
+            self.size = self.total_size()
+
+    def on_evict(self, key: str):
+        """Called for each removed entry, e.g. to delete its files."""
+
+    def evict(self):
+        with self.lock:
+            # other processes can have added entries in the meantime
+            size = self.total_size()
+
+            # remove least recently used entries until well under the budget, so
+            # the next eviction is not on the next store
+            with self.conn:
+                for key, entry_size in self.conn.execute(
+                    f"SELECT key, {self.size_sql} FROM {self.table} ORDER BY accessed"
+                ).fetchall():
+                    if size <= self.max_bytes * 0.9:
+                        break
+                    self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    self.on_evict(key)
+                    size -= entry_size
+            self.size = size
+
+
+class DetectorError(RuntimeError):
+    pass
+
+
+class FaceDetector:
+    """
+    Long running face detector process, so the model is only loaded once.
+    The command can be overridden with the FACE_DETECTOR_CMD environment variable,
+    e.g. `FACE_DETECTOR_CMD="python detect_worker.py --fake"` for a CPU only stub.
+    """
+
+    def __init__(self, cmd: list[str] | None = None):
+        self.cmd = cmd or shlex.split(os.environ.get("FACE_DETECTOR_CMD", ""))
+        if not self.cmd:
+            self.cmd = [sys.executable, str(Path(__file__).parent / "detect_worker.py")]
+        self.proc: subprocess.Popen | None = None
+        # the detector can be shared between threads, one request at a time
+        self.lock = threading.Lock()
+
+    def cache_version(self) -> str:
+        """
+        Identifies the results of the detector. For detect_worker.py only its own
+        arguments count, so moving the repo or changing python keeps the cache.
+        """
+        for i, arg in enumerate(self.cmd):
+            if Path(arg).name == "detect_worker.py":
+                return detect_worker.cache_version(
+                    detect_worker.parse_args(self.cmd[i + 1 :])
+                )
+        # other commands are only known by their command line
+        return f"{detect_worker.DETECTOR_VERSION}:{' '.join(self.cmd)}"
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+
+    def close(self):
+        if self.proc is None:
+            return
+
+        self.proc.stdin.close()
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.proc = None
+
+    @timed("detect")
+    def _request(self, images: list[str]) -> dict[str, list[Face] | None]:
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        PROFILER.count("detected images", len(images))
+
+        self.proc.stdin.write(json.dumps(images) + "\n")
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline()
+        if not line:
+            raise DetectorError(f"face detector exited with {self.proc.poll()}")
+
+        result = json.loads(line)
+        if any(image not in result for image in images):
+            raise DetectorError(f"face detector returned incomplete result: {line}")
+        return result
+
+    def detect_batch(
+        self, images: list[str], retries=1
+    ) -> dict[str, list[Face] | None]:
+        """Faces are None for images the detector could not process."""
+        with self.lock:
+            for attempt in range(retries + 1):
+                try:
+                    return self._request(images)
+                except (OSError, ValueError, DetectorError) as e:
+                    # restart the worker on the next request
+                    self.close()
+                    if attempt == retries:
+                        raise DetectorError(
+                            f"face detection failed for {images}"
+                        ) from e
+
+    def detect(self, image: str) -> list[Face]:
+        faces = self.detect_batch([image])[image]
+        if faces is None:
+            raise DetectorError(f"face detection failed for {image}")
+        return faces
+
+    def detect_iter(self, images):
+        for image in images:
+            yield image, self.detect(image)
+
+
+@shared_instance
+def get_detector() -> FaceDetector:
+    detector = FaceDetector()
+    atexit.register(detector.close)
+    return detector
+
+
+class FaceCache(LRUCache):
+    """
+    On disk cache of detected faces, keyed by the image path, size and modified time
+    and the detector version. Least recently used entries are evicted once the cache
+    exceeds max_bytes.
+    """
+
+    def __init__(
+        self,
+        path: Path = CACHE_DIR / "faces.db",
+        version: str = detect_worker.DETECTOR_VERSION,
+        max_bytes: int = 64 * 1024 * 1024,
+    ):
+        super().__init__(
+            path,
+            "faces",
+            "faces TEXT NOT NULL",
+            "LENGTH(key) + LENGTH(faces)",
+            max_bytes,
+        )
+        self.version = version
+
+    def key(self, image, variant="") -> str:
+        """variant distinguishes results of the same image detected differently."""
+        return f"{file_key(image)}:{self.version}{variant}"
+
+    def get(self, image, variant="") -> list[Face] | None:
+        row = self.lookup(self.key(image, variant), "faces")
+        if row is None:
+            PROFILER.count("face cache misses")
+            return None
+
+        PROFILER.count("face cache hits")
+        return json.loads(row[0])
+
+    def put(self, image, faces: list[Face], variant=""):
+        key = self.key(image, variant)
+        value = json.dumps(faces, separators=(",", ":"))
+        self.store(key, (value,), len(key) + len(value))
+
+
+@shared_instance
+def get_face_cache() -> FaceCache:
+    # results from differently configured detectors should not be mixed
+    return FaceCache(version=get_detector().cache_version())
+
+
+def _detect_variant(image, max_side: int | None) -> tuple[str, Dimensions | None]:
+    """
+    Returns the cache variant of detecting the image with max_side, and the size
+    of the image if it is downscaled.
+    """
+    size = image_size(image) if max_side else None
+    # only downscaled images give different results
+    if size and max(size) > max_side:
+        return f":{max_side}", size
+    return "", None
+
+
+def _downscale(image, size: Dimensions, max_side: int, out_path: Path) -> Dimensions:
+    """Writes the image downscaled to max_side to out_path, returns its size."""
+    scale = max_side / max(size)
+    small_size = (round(size[0] * scale), round(size[1] * scale))
+    with PROFILER.timer("decode"):
+        img = cv2.imread(str(image))
+    if img is None:
+        raise DetectorError(f"cannot decode {image}")
+    cv2.imwrite(
+        str(out_path), cv2.resize(img, small_size, interpolation=cv2.INTER_AREA)
     )
-    line = result.stdout.splitlines()[0]
-    return list(json.loads(line).values())[0]
+    return small_size
 
 
-def iter_images(p: Path):
-    for img in p.iterdir():
-        if not img.is_file():
-            continue
+def detect(image, max_side: int | None = None) -> list[Face]:
+    """
+    Detects the faces in the image. Images larger than max_side are downscaled
+    before detection, which is much faster, and the boxes are scaled back up.
+    """
+    cache = get_face_cache()
+    variant, size = _detect_variant(image, max_side)
+
+    faces = cache.get(image, variant)
+    if faces is not None:
+        return faces
+
+    if not variant:
+        faces = get_detector().detect(str(image))
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            small_path = Path(tmpdir) / f"{Path(image).stem}.png"
+            small_size = _downscale(image, size, max_side, small_path)
+            faces = scale_faces(
+                get_detector().detect(str(small_path)), small_size, size
+            )
+
+    cache.put(image, faces, variant)
+    return faces
+
+
+def scale_faces(
+    faces: list[Face], from_size: Dimensions, to_size: Dimensions
+) -> list[Face]:
+    """
+    Maps faces detected on an image of from_size to the same image resized to
+    to_size, e.g. from the source image to the upscaled output.
+    """
+    (from_w, from_h), (to_w, to_h) = from_size, to_size
+    return [
+        Face(
+            xmin=min(round(face["xmin"] * to_w / from_w), to_w),
+            ymin=min(round(face["ymin"] * to_h / from_h), to_h),
+            xmax=min(round(face["xmax"] * to_w / from_w), to_w),
+            ymax=min(round(face["ymax"] * to_h / from_h), to_h),
+        )
+        for face in faces
+    ]
+
 
-        if img.suffix == ".json":
+def detect_many(
+    images, batch_size=32, max_side: int | None = None, progress=True
+) -> dict[Any, list[Face]]:
+    """
+    Detects faces for many images, sending batch_size images to the detector at
+    a time. Falls back to detecting images one by one if a batch fails.
+    Images with cached faces are not sent to the detector, images larger than
+    max_side are downscaled like with detect().
+    Returns a dict of {image: faces}, without the images that failed detection.
+    """
+    cache = get_face_cache()
+    detector = get_detector()
+
+    ret = {}
+    # image: (cache variant, size if downscaled)
+    uncached = {}
+    for image in images:
+        try:
+            variant, size = _detect_variant(image, max_side)
+        except OSError as e:
+            print(f"{image}: face detection failed: {e}")
             continue
+        faces = cache.get(image, variant)
+        if faces is None:
+            uncached[image] = (variant, size)
+        else:
+            ret[image] = faces
+
+    if ret and progress:
+        print(f"using cached faces for {len(ret)} images")
+
+    uncached_images = list(uncached)
+    for batch_start in range(0, len(uncached_images), batch_size):
+        batch = uncached_images[batch_start : batch_start + batch_size]
+
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # the path sent to the detector and the size of the image it has
+            sources = {}
+            for i, image in enumerate(batch):
+                _, size = uncached[image]
+                if size is None:
+                    sources[image] = (str(image), None)
+                    continue
 
-        if img.suffix == ".csv":
+                small_path = Path(tmpdir) / f"{i}.png"
+                try:
+                    small_size = _downscale(image, size, max_side, small_path)
+                except DetectorError as e:
+                    print(f"{image}: face detection failed: {e}")
+                    continue
+                sources[image] = (str(small_path), small_size)
+
+            detected = {}
+            try:
+                result = (
+                    detector.detect_batch([src for src, _ in sources.values()])
+                    if sources
+                    else {}
+                )
+                for image in sources:
+                    if result[sources[image][0]] is None:
+                        print(f"{image}: face detection failed")
+                        continue
+                    detected[image] = result[sources[image][0]]
+            except DetectorError as e:
+                print(f"batch failed, detecting images individually: {e}")
+                for image in sources:
+                    # skip unreadable images instead of failing the whole run
+                    try:
+                        detected[image] = detector.detect(sources[image][0])
+                    except DetectorError as e:
+                        print(f"{image}: face detection failed: {e.__cause__ or e}")
+        elapsed = time.perf_counter() - start
+
+        for image, faces in detected.items():
+            variant, size = uncached[image]
+            if size is not None:
+                faces = scale_faces(faces, sources[image][1], size)
+            ret[image] = faces
+            cache.put(image, faces, variant)
+
+        if progress:
+            print(
+                f"detected {batch_start + len(batch)}/{len(uncached)} images "
+                f"({len(batch) / elapsed:.2f} images/s)"
+            )
+
+    return ret
+
+
+# (filename, (width, height), faces) of a wallpaper
+GeometryRow = tuple[str, Dimensions, np.ndarray]
+
+
+def _wallpaper_geometries(ratios: list[AspectRatio], row: GeometryRow):
+    fname, dimensions, faces = row
+    cropper = Cropper(dimensions, faces)
+    return fname, cropper.geometries(ratios)
+
+
+def _chunk_geometries(ratios: list[AspectRatio], rows: list[GeometryRow]):
+    return [_wallpaper_geometries(ratios, row) for row in rows]
+
+
+def geometry_rows(image_data: WallpaperInfo) -> list[GeometryRow]:
+    """Rows of the wallpapers with known dimensions, see backfill_dimensions()."""
+    return [
+        (fname, (wall["width"], wall["height"]), wall["faces"])
+        for fname, wall in image_data.items()
+        if wall.get("width") and wall.get("height")
+    ]
+
+
+def iter_geometries(
+    rows: list[GeometryRow],
+    ratios: list[AspectRatio] = GEOMETRY_RATIOS,
+    workers: int | None = None,
+    chunk_size=500,
+    pool_threshold=5000,
+):
+    """
+    Computes the geometries of the rows in chunks of chunk_size, yielding a list of
+    (filename, geometries) for each chunk as it completes. At least pool_threshold
+    rows are processed in a process pool.
+    """
+    compute = functools.partial(_chunk_geometries, ratios)
+    chunks = [rows[i : i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+    if len(rows) < pool_threshold:
+        for chunk in chunks:
+            yield compute(chunk)
+        return
+
+    executor = ProcessPoolExecutor(workers)
+    try:
+        futures = [executor.submit(compute, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # don't wait for the remaining chunks if interrupted
+        executor.shutdown(cancel_futures=True)
+
+
+def update_geometries(
+    image_data: WallpaperInfo, geometries: dict[str, dict[str, str]]
+) -> int:
+    """
+    Updates the geometries of the wallpapers in a single save. Returns the number
+    of geometries that changed.
+    """
+    changed = 0
+    for fname, new in geometries.items():
+        wall = image_data.load(fname)
+        diff = sum(wall.get(key) != value for key, value in new.items())
+        if diff:
+            image_data[fname].update(new)
+            changed += diff
+    image_data.save()
+    return changed
+
+
+def recompute_geometries(
+    image_data: WallpaperInfo,
+    ratios: list[AspectRatio] = GEOMETRY_RATIOS,
+    workers: int | None = None,
+    pool_threshold=5000,
+) -> int:
+    """
+    Recomputes the geometries of all wallpapers from their stored dimensions and
+    faces, without reading the images. Returns the number of wallpapers.
+    """
+    image_data.backfill_dimensions()
+
+    geometries = {}
+    rows = geometry_rows(image_data)
+    for chunk in iter_geometries(
+        rows, ratios, workers=workers, pool_threshold=pool_threshold
+    ):
+        geometries.update(chunk)
+    update_geometries(image_data, geometries)
+
+    return len(rows)
+
+
+def compute_missing_ratios(
+    image_data: WallpaperInfo, workers: int | None = None
+) -> list[AspectRatio]:
+    """
+    Computes the geometries of configured ratios that are missing, e.g. after
+    adding a ratio. Ratios that are already computed are not recomputed.
+    """
+    missing = image_data.missing_ratios()
+    if missing:
+        print(f"computing new ratios: {', '.join(map(ratio_str, missing))}")
+        recompute_geometries(image_data, missing, workers)
+        # marks the ratios as complete
+        image_data.missing_ratios()
+    return missing
+
+
+def add_wallpapers(image_data: WallpaperInfo, images: list[Path]) -> list[str]:
+    """
+    Detects faces and computes the geometries of the images, replacing any rows.
+    Returns the names of the images that were added, images that could not be
+    detected or read are skipped.
+    """
+    added = []
+    for img, faces in detect_many(images).items():
+        print(img.name)
+
+        try:
+            width, height = image_size(img)
+            digest = dhash(img)
+        except OSError as e:
+            print(f"{img}: could not be read: {e}")
             continue
 
-        yield img
+        cropper = Cropper((width, height), faces)
+        image_data[img.name] = {
+            "filename": img.name,
+            "faces": cropper.boxes,
+            **cropper.geometries(),
+            "width": width,
+            "height": height,
+            "dhash": digest,
+        }
+        added.append(img.name)
+
+    image_data.save()
+    return added
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+OXIPNG_ARGS = ["--opt", "max"]
+
+
+class OptimizeLedger(CacheDB):
+    """
+    Hashes of pngs that oxipng has already optimized, with the arguments used,
+    so unchanged files are not optimized again. Keyed by the hash after
+    optimization, so it stays valid when files are renamed or copied.
+    """
+
+    def __init__(self, path: Path = CACHE_DIR / "oxipng.db"):
+        super().__init__(
+            path, "optimized (hash TEXT PRIMARY KEY, settings TEXT NOT NULL)"
+        )
+
+    def is_optimized(self, digest: str, settings: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT settings FROM optimized WHERE hash = ?", (digest,)
+            ).fetchone()
+        return row is not None and row[0] == settings
+
+    def add(self, digest: str, settings: str):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO optimized VALUES (?, ?)", (digest, settings)
+            )
+
+
+@shared_instance
+def get_optimize_ledger() -> OptimizeLedger:
+    return OptimizeLedger()
+
+
+def optimize_png(path: Path, args: list[str] = OXIPNG_ARGS) -> int | None:
+    """
+    Optimizes the png in place with oxipng, unless the ledger shows it has already
+    been optimized with the same arguments. Returns the bytes saved, or None if the
+    file was skipped.
+    """
+    ledger = get_optimize_ledger()
+    settings = " ".join(args)
+    if ledger.is_optimized(file_hash(path), settings):
+        PROFILER.count("oxipng skipped")
+        return None
+
+    size = path.stat().st_size
+    with PROFILER.timer("oxipng"):
+        proc = subprocess.run(["oxipng", *args, path])
+    if proc.returncode == 0:
+        ledger.add(file_hash(path), settings)
+    return size - path.stat().st_size
+
+
+def dhash(image) -> str:
+    """
+    Perceptual difference hash of the image as hex, which stays (nearly) the same
+    when the image is resized or recompressed, e.g. upscaled or converted to png.
+    """
+    with PROFILER.timer("dhash"), Image.open(image) as img:
+        # jpegs can be decoded at a fraction of the size
+        img.draft("L", (DHASH_SIZE * 16, DHASH_SIZE * 16))
+        small = img.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BOX)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return bits.tobytes().hex()
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """
+    Multi-index hashing, to find the hashes within max_distance bits of a hash
+    without comparing against all of them. The hashes are split into
+    max_distance + 1 chunks, hashes within max_distance bits of each other have at
+    least one identical chunk, so only hashes sharing a chunk need to be compared.
+
+    Degenerate hashes are never added or matched, see is_degenerate().
+    """
+
+    def __init__(
+        self, max_distance: int = DUPLICATE_DISTANCE, bits: int = DHASH_SIZE**2
+    ):
+        self.max_distance = max_distance
+        self.bits = bits
+        count = max_distance + 1
+        # (shift, mask) of each chunk
+        self.chunks = []
+        shift = 0
+        for i in range(count):
+            width = bits // count + (i < bits % count)
+            self.chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables: list[dict[int, list[int]]] = [
+            defaultdict(list) for _ in range(count)
+        ]
+        self.entries: list[tuple[int, Any]] = []
+
+    def is_degenerate(self, value: int) -> bool:
+        """
+        Flat or low detail images, e.g. solid colors or smooth gradients, have
+        (nearly) all bits the same regardless of their content, so they would
+        match each other.
+        """
+        ones = value.bit_count()
+        return min(ones, self.bits - ones) <= self.max_distance
+
+    def add(self, value: int, item):
+        if self.is_degenerate(value):
+            return
+
+        idx = len(self.entries)
+        self.entries.append((value, item))
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            table[(value >> shift) & mask].append(idx)
+
+    def search(self, value: int) -> list[tuple[int, Any]]:
+        """Returns (distance, item) of the matching items, closest first."""
+        if self.is_degenerate(value):
+            return []
+
+        candidates = set()
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            candidates.update(table.get((value >> shift) & mask, ()))
+
+        matches = []
+        for idx in candidates:
+            other, item = self.entries[idx]
+            distance = hamming_distance(value, other)
+            if distance <= self.max_distance:
+                matches.append((distance, item))
+        return sorted(matches, key=lambda match: match[0])
+
+
+def image_size(image) -> Dimensions:
+    """
+    Reads the (width, height) of an image from its header, without decoding it.
+    Accounts for the exif orientation, like cv2.imread does.
+    """
+    with PROFILER.timer("image_size"), Image.open(image) as img:
+        width, height = img.size
+        # getexif() decodes the whole image for pngs, only check exif for jpegs
+        if img.format != "JPEG":
+            return width, height
+
+        # rotated by 90 or 270 degrees
+        if img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            return height, width
+        return width, height
+
+
+def is_image(img: Path) -> bool:
+    if img.suffix == ".json":
+        return False
+
+    if img.suffix == ".csv":
+        return False
+
+    # metadata database and its journal
+    if img.suffix.startswith(".db"):
+        return False
+
+    return True
+
+
+def iter_images(p: Path):
+    for img in p.iterdir():
+        if img.is_file() and is_image(img):
+            yield img
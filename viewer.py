@@ -0,0 +1,287 @@
+import cv2
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, NamedTuple
+from utils import (
+    CACHE_DIR,
+    PROFILER,
+    Dimensions,
+    Face,
+    LRUCache,
+    file_key,
+    image_size,
+    shared_instance,
+)
+
+DISPLAY_WIDTH = 1280
+# reduction factors supported by cv2.imread
+REDUCED_READ_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+THUMBNAIL_QUALITY = 90
+THUMBNAIL_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class Frame(NamedTuple):
+    # display ready image
+    image: Any
+    # anything else the caller needs for the image, e.g. the drawn boxes
+    data: Any = None
+
+
+def resize_for_display(image):
+    h, w = image.shape[:2]
+    return cv2.resize(image, (DISPLAY_WIDTH, int(h / w * DISPLAY_WIDTH)))
+
+
+def decode_for_display(path) -> tuple[Any, Dimensions, float]:
+    """
+    Decodes the image at a reduced size that is still at least DISPLAY_WIDTH wide.
+    Returns (image, full (width, height), scale of the image relative to the full
+    size).
+    """
+    width, height = image_size(path)
+
+    # jpegs can be decoded directly at a reduced size
+    if Path(path).suffix.lower() in (".jpg", ".jpeg"):
+        flag = cv2.IMREAD_COLOR
+        for factor, reduced_flag in REDUCED_READ_FLAGS.items():
+            if width // factor >= DISPLAY_WIDTH:
+                flag = reduced_flag
+                break
+
+        with PROFILER.timer("decode"):
+            image = cv2.imread(str(path), flag)
+    # other formats need a full decode, but can be downscaled before drawing
+    else:
+        with PROFILER.timer("decode"):
+            image = cv2.imread(str(path))
+        if image is not None and width > DISPLAY_WIDTH:
+            image = resize_for_display(image)
+
+    # truncated images have a valid header, but cannot be decoded
+    if image is None:
+        raise OSError(f"cannot decode {path}")
+    return image, (width, height), image.shape[1] / width
+
+
+class ThumbnailCache(LRUCache):
+    """
+    On disk cache of images scaled down for display, stored as jpegs so they are
+    much faster to decode than the full size wallpapers. Keyed by the image path,
+    size and modified time. Least recently used thumbnails are deleted once the
+    cache exceeds max_bytes.
+    """
+
+    def __init__(
+        self, path: Path = CACHE_DIR / "thumbs", max_bytes: int = THUMBNAIL_MAX_BYTES
+    ):
+        super().__init__(
+            path / "thumbs.db",
+            "thumbs",
+            "width INTEGER NOT NULL, height INTEGER NOT NULL, scale REAL NOT NULL, "
+            "bytes INTEGER NOT NULL",
+            "bytes",
+            max_bytes,
+        )
+        self.dir = path
+
+    def thumb_path(self, key: str) -> Path:
+        return (
+            self.dir
+            / f"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.jpg"
+        )
+
+    def on_evict(self, key: str):
+        self.thumb_path(key).unlink(missing_ok=True)
+
+    def __contains__(self, image) -> bool:
+        key = file_key(image)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM thumbs WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None and self.thumb_path(key).exists()
+
+    def get(self, image) -> tuple[Any, Dimensions, float] | None:
+        """Returns the same (image, dimensions, scale) as decode_for_display."""
+        key = file_key(image)
+        row = self.lookup(key, "width, height, scale")
+        if row is None:
+            PROFILER.count("thumbnail misses")
+            return None
+
+        with PROFILER.timer("decode"):
+            thumb = cv2.imread(str(self.thumb_path(key)))
+        # deleted from outside the cache
+        if thumb is None:
+            self.remove(key)
+            PROFILER.count("thumbnail misses")
+            return None
+
+        PROFILER.count("thumbnail hits")
+        width, height, scale = row
+        return thumb, (width, height), scale
+
+    def create(self, image) -> tuple[Any, Dimensions, float]:
+        """Decodes the image and adds its thumbnail, returns it like get."""
+        thumb, dimensions, scale = decode_for_display(image)
+        # reduced jpegs can be up to twice as wide
+        if thumb.shape[1] > DISPLAY_WIDTH:
+            thumb = resize_for_display(thumb)
+            scale = thumb.shape[1] / dimensions[0]
+        self.put(image, thumb, dimensions, scale)
+        return thumb, dimensions, scale
+
+    def put(self, image, thumb, dimensions: Dimensions, scale: float):
+        key = file_key(image)
+        path = self.thumb_path(key)
+        # written under a temporary name, so partial thumbnails are never read
+        tmp_path = path.with_name(f".{threading.get_ident()}.{path.name}")
+        cv2.imwrite(str(tmp_path), thumb, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+        os.replace(tmp_path, path)
+
+        size = path.stat().st_size
+        self.store(key, (*dimensions, scale, size), size)
+
+
+@shared_instance
+def get_thumbnail_cache() -> ThumbnailCache:
+    return ThumbnailCache()
+
+
+def read_for_display(path, cached=True) -> tuple[Any, Dimensions, float]:
+    """
+    Same as decode_for_display, but reads the image from the thumbnail cache if
+    cached, and adds it to the cache on a miss.
+    """
+    if not cached:
+        return decode_for_display(path)
+
+    thumbnails = get_thumbnail_cache()
+    return thumbnails.get(path) or thumbnails.create(path)
+
+
+def scale_boxes(boxes: list[Face], scale: float) -> list[Face]:
+    return [
+        Face(
+            xmin=int(box["xmin"] * scale),
+            ymin=int(box["ymin"] * scale),
+            xmax=int(box["xmax"] * scale),
+            ymax=int(box["ymax"] * scale),
+        )
+        for box in boxes
+    ]
+
+
+class FrameCache:
+    """LRU cache of frames, evicting the oldest frames once over max_bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.frames: OrderedDict[int, Frame | None] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def frame_size(frame: Frame | None) -> int:
+        return 0 if frame is None else frame.image.nbytes
+
+    def get(self, idx: int) -> Frame | None:
+        with self.lock:
+            self.frames.move_to_end(idx)
+            return self.frames[idx]
+
+    def __contains__(self, idx: int) -> bool:
+        return idx in self.frames
+
+    def put(self, idx: int, frame: Frame | None):
+        with self.lock:
+            if idx in self.frames:
+                self.size -= self.frame_size(self.frames.pop(idx))
+            self.frames[idx] = frame
+            self.size += self.frame_size(frame)
+
+            # always keep the newest frame
+            while self.size > self.max_bytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.size -= self.frame_size(evicted)
+
+
+class Viewer:
+    """
+    Renders the images at the given paths in background threads, prefetching the
+    next and previous images so navigating between them does not wait on decoding
+    and face detection.
+
+    render returns the Frame to display for a path, or None to skip the image.
+    """
+
+    def __init__(
+        self,
+        paths: list,
+        render: Callable[[Any], Frame | None],
+        prefetch=3,
+        max_bytes=512 * 1024 * 1024,
+        workers=2,
+    ):
+        self.paths = paths
+        self.render = render
+        self.prefetch = prefetch
+        self.cache = FrameCache(max_bytes)
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending: dict[int, Future] = {}
+        # reentrant, as the done callback runs in _submit if already done
+        self.lock = threading.RLock()
+
+    def _submit(self, idx: int) -> Future | None:
+        if idx < 0 or idx >= len(self.paths):
+            return None
+
+        with self.lock:
+            if idx in self.cache:
+                return None
+
+            future = self.pending.get(idx)
+            if future is None:
+                future = self.executor.submit(self.render, self.paths[idx])
+                self.pending[idx] = future
+                future.add_done_callback(lambda f: self._done(idx, f))
+        # the callback may already have removed the future from pending
+        return future
+
+    def _done(self, idx: int, future: Future):
+        with self.lock:
+            if not future.cancelled() and future.exception() is None:
+                self.cache.put(idx, future.result())
+            # a newer future could have been submitted for idx in the meantime
+            if self.pending.get(idx) is future:
+                del self.pending[idx]
+
+    def get(self, idx: int) -> Frame | None:
+        """Returns the frame at idx, waiting for it to render if needed."""
+        future = self._submit(idx)
+
+        # nearest images first
+        for offset in range(1, self.prefetch + 1):
+            self._submit(idx + offset)
+            self._submit(idx - offset)
+
+        if future is None:
+            try:
+                return self.cache.get(idx)
+            except KeyError:
+                # evicted by a prefetched frame in the meantime
+                future = self._submit(idx)
+
+        # raises any exception from rendering
+        return future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)